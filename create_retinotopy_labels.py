@@ -13,7 +13,7 @@ fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
 os.chdir(PROJ_DIR)
 run_dir = op.abspath(f'derivatives/pRF/sub-{subject}/ses-{session}/{run}')
 surface = f'{fs_subj_dir}/surf/{hemi}.inflated'
-overlay = f'{run_dir}/polar_angle_{hemi}.mgh'
+overlay = f'{run_dir}/polar_angle_smoothed_{hemi}.mgh'
 #overlay = f'{run_dir}/r2_{hemi}.mgh'
 mask = op.abspath(f'derivatives/ROIs/sub-{subject}/ses-{session}/mask_r2_thresh_{hemi}.label')
 #mask = op.abspath(f'derivatives/ROIs/sub-{subject}/ses-{session}/mask_analyzed_{hemi}.label')
@@ -37,8 +37,6 @@ if colormap == 'red_yellow_green':
 # colorwheel
 else:
     colors = np.linspace(0, 1, 37)
-    if hemi == 'lh':  # flip colormap as datamap was previously flipped
-        colors = -(colors + .5) % 1
     colorwheel = np.hstack((
         np.linspace(0, 360, 37, dtype=int).reshape(-1, 1),
         np.array(mpl.colormaps['hsv'](colors) * 255, int)[:,:-1]))
@@ -53,7 +51,6 @@ cmd = (
     f':overlay={overlay}'
     f':curvature_method=binary'
     f':overlay_custom={cmap}'
-    f':overlay_smooth=8'
     f':overlay_mask={mask}'
     f':label={label}'
     f':label_outline=true'
@@ -4,11 +4,14 @@ import os
 import os.path as op
 import glob
 from itertools import product as itp
+import numpy as np
 import nibabel as nib
 import matplotlib.pyplot as plt
 from scipy.stats import linregress
 
-from config import PROJ_DIR, subjects
+from utils.config import PROJ_DIR, subjects
+from utils.labels import read_label, write_label, union, label_volume
+from utils.surface_sampling import cached_vertex_voxels
 
 R2_THR = 50
 MIN_ECCEN = 0.5
@@ -22,38 +25,33 @@ def prf_stats():
         roi_dir = f'derivatives/ROIs/sub-{subject}/ses-{session}'
         ref_func = glob.glob(f'derivatives/registration/sub-{subject}/'
                              f'ses-{session}/example_func.nii*')[0]
-        reg = (f'derivatives/registration/sub-{subject}/ses-{session}/'
-               f'example_func2highres.lta')
 
         # V1 labels to nifti
         fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+        ref = nib.load(ref_func)
+        V1 = f'{roi_dir}/V1.nii.gz'
         for hemi in ['lh', 'rh']:
 
             # label should either exist or be created by merging dorsal, ventral
             label = f'{fs_subj_dir}/label/{hemi}.tong.V1.label'
             if not op.isfile(label):
-                os.system(f'mri_mergelabels '
-                          f'-i {label.replace(".V1.", ".V1d.")} '
-                          f'-i {label.replace(".V1.", ".V1v.")} '
-                          f'-o {label}')
+                vertices = union(*[read_label(label.replace('.V1.', part))[0]
+                                   for part in ['.V1d.', '.V1v.']])
+                write_label(label, vertices, subject, hemi)
 
             # label to nifti
             outpath = f'{roi_dir}/V1_{hemi}.nii.gz'
             if not op.isfile(outpath):
-                os.system(
-                    f'mri_label2vol '
-                    f'--label {label} '
-                    f'--temp {ref_func} '
-                    f'--reg {reg} '
-                    f'--subject sub-{subject} '
-                    f'--hemi {hemi} '
-                    f'--o {outpath}')
+                voxels = cached_vertex_voxels(subject, f'ses-{session}', hemi)
+                volume = label_volume([read_label(label)[0]], voxels,
+                                      ref.shape[:3])
+                nib.save(nib.Nifti1Image(volume, ref.affine), outpath)
 
         # combine across hemispheres
-        V1s = glob.glob(f'{roi_dir}/V1_?h.nii.gz')
-        V1 = f'{roi_dir}/V1.nii.gz'
         if not op.isfile(V1):
-            os.system(f'fslmaths {" -add ".join(V1s)} -bin {V1}')
+            volume = sum(nib.load(f'{roi_dir}/V1_{hemi}.nii.gz').get_fdata()
+                         for hemi in ['lh', 'rh']) > 0
+            nib.save(nib.Nifti1Image(volume.astype(np.uint8), ref.affine), V1)
 
         # get eccentricity, rfsize and r2
         roi = nib.load(V1).get_fdata().flatten()
@@ -46,13 +46,29 @@ if __name__ == "__main__":
 
     # do prf mapping
     #from utils import estimate_pRFs
-    #estimate_pRFs()
+    #estimate_pRFs(num_procs)
     """
     # do some post-processing on maps and convert to surfaces
     from utils import make_surface_maps
     make_surface_maps(overwrite=False)
 
-    # manually make retinotopic ROI labels using create_retinotopy_labels.py
+    # pool pRF maps across subjects in standard space, and on fsaverage
+    from utils import group_maps, fsaverage_maps
+    group_maps()
+    fsaverage_maps()
+
+    # draft early visual area labels from field sign, then check and edit
+    # them manually using create_retinotopy_labels.py
+    from utils import draft_visual_labels
+    draft_visual_labels()
+
+    # snapshots of every subject's surface maps for review
+    from utils import contact_sheet
+    contact_sheet(num_procs=num_procs)
+
+    # wait for any QC images still rendering in the background
+    from utils import wait_for_qc
+    wait_for_qc()
 
     finish = time.time()
     print(f'analysis took {seconds_to_text(finish - start)} to complete')
@@ -0,0 +1,48 @@
+# /usr/bin/python
+"""
+One-off migration for pRF outputs made before the left hemisphere polar
+angle flip (540 - angle) was removed from make_surface_maps. Those versions
+wrote polar_angle_lh.mgh flipped, and make_surface_maps(overwrite=False)
+keeps existing overlays. For every volume fit, this removes the left
+hemisphere polar angle overlay, the baseline polar_angle_flip.nii.gz and
+everything derived from the overlay (smoothed and fsaverage copies, field
+sign, draft labels, snapshot), then remakes the overlay unflipped. Run it
+once, then rerun the post-processing stages of pipeline.py to remake the
+rest. Surface fits write their overlays directly and need refitting.
+"""
+
+import os
+import os.path as op
+import glob
+from utils.config import PROJ_DIR
+from utils.make_surface_maps import make_surface_maps
+
+
+def lh_polar_angle_outputs(prf_dir):
+
+    """ Left hemisphere polar angle overlay and the files derived from it """
+
+    subject, session = prf_dir.split('/')[2:4]
+    roi_dir = f'derivatives/ROIs/{subject}/{session}'
+    return [f'{prf_dir}/polar_angle_lh.mgh',
+            f'{prf_dir}/polar_angle_flip.nii.gz',
+            f'{prf_dir}/polar_angle_smoothed_lh.mgh',
+            f'{prf_dir}/field_sign_lh.mgh',
+            f'{prf_dir}/snapshots_lh.png',
+            *glob.glob(f'{prf_dir}/fsaverage/polar_angle*_lh.mgh'),
+            f'{prf_dir}/fsaverage/field_sign_lh.mgh',
+            *glob.glob(f'{roi_dir}/lh.tong_draft.*.label')]
+
+
+if __name__ == "__main__":
+
+    os.chdir(PROJ_DIR)
+    for prf_dir in sorted(glob.glob('derivatives/pRF/sub-*/*/'
+                                    'mean_before_prf')):
+        if not op.isfile(f'{prf_dir}/polar_angle.nii'):
+            continue
+        print(f'Removing left hemisphere polar angle outputs in {prf_dir}...')
+        for path in lh_polar_angle_outputs(prf_dir):
+            if op.isfile(path):
+                os.remove(path)
+    make_surface_maps()
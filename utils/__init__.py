@@ -8,8 +8,13 @@ from .seconds_to_text import seconds_to_text
 from .initialise_BIDS import initialise_BIDS
 from .check_segmentation import check_segmentation
 from .registration import registration
-#from .estimate_pRFs import estimate_pRFs
+from .estimate_pRFs import estimate_pRFs
 from .make_surface_maps import make_surface_maps
+from .group_maps import group_maps
+from .fsaverage import fsaverage_maps
+from .field_sign import draft_visual_labels
+from .surface_snapshots import contact_sheet
+from .qc_montage import wait_for_qc
 import datetime
 
 
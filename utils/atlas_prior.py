@@ -0,0 +1,103 @@
+# /usr/bin/python
+"""
+Template retinotopy as a prior for pRF fitting. neuropythy's atlas command
+(run by get_wang_atlas) also writes the Benson et al. (2014) retinotopy
+template as volumes in the subject's freesurfer space. These are resampled
+into each session's functional space and converted to visual field
+coordinates, giving a starting estimate for every analysed voxel.
+"""
+
+import os
+import os.path as op
+import glob
+import numpy as np
+import nibabel as nib
+from .resample import resample
+
+# ribbon.mgz labels of left and right cerebral cortex
+RIBBON_LABELS = {'lh': 3, 'rh': 42}
+
+
+def atlas_priors(subject, session, indices, overwrite=False):
+
+    """
+    Args:
+        subject (str): subject ID, without the 'sub-' prefix
+        session (str): session directory name
+        indices (np.ndarray): flat indices of the analysed voxels, see
+            masked_timeseries.mask_indices
+
+    Returns:
+        priors (np.ndarray): voxels x [x, y, sigma] (deg), with x and y in
+            the same convention as the pRF fits (x right, y up). NaN where
+            the voxel lies outside the template's visual areas.
+    """
+
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    reg_dir = f'derivatives/registration/sub-{subject}/{session}'
+    roi_dir = f'derivatives/ROIs/sub-{subject}/{session}'
+    ref_func = glob.glob(f'{reg_dir}/example_func.nii*')[0]
+    reg = f'{reg_dir}/example_func2highres.lta'
+
+    # resample template maps and cortical ribbon into functional space
+    maps = {}
+    for param in ['angle', 'eccen', 'sigma', 'varea', 'ribbon']:
+        if param == 'ribbon':
+            in_path = f'{fs_subj_dir}/mri/ribbon.mgz'
+        else:
+            in_path = f'{fs_subj_dir}/mri/benson14_{param}.mgz'
+        out_path = f'{roi_dir}/benson14_{param}.nii.gz'
+        if not op.isfile(out_path) or overwrite:
+            print(f'Transforming benson14 {param} to functional space...')
+            resample(in_path, ref_func, reg, out_path, order=0, invert=True)
+        maps[param] = np.asarray(nib.load(out_path).dataobj).ravel(
+            order='F')[indices].astype(float)
+
+    side = np.full(len(indices), np.nan)
+    side[maps['ribbon'] == RIBBON_LABELS['lh']] = 1  # right visual field
+    side[maps['ribbon'] == RIBBON_LABELS['rh']] = -1
+    return _template_priors(maps, side)
+
+
+def surface_atlas_priors(subject, vertices):
+
+    """
+    As atlas_priors, for surface-based fits, reading the template directly
+    from the subject's surface overlays.
+
+    Args:
+        subject (str): subject ID, without the 'sub-' prefix
+        vertices (dict): hemi -> (analysed vertices, number of vertices), see
+            surface_sampling.surface_projection
+
+    Returns:
+        priors (np.ndarray): analysed vertices (lh then rh) x [x, y, sigma]
+    """
+
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    priors = []
+    for hemi, side in zip(['lh', 'rh'], [1, -1]):
+        analysed = vertices[hemi][0]
+        maps = {param: np.asarray(nib.load(
+            f'{fs_subj_dir}/surf/{hemi}.benson14_{param}.mgz').dataobj)
+            .ravel()[analysed].astype(float)
+            for param in ['angle', 'eccen', 'sigma', 'varea']}
+        priors.append(_template_priors(maps, np.full(len(analysed), side)))
+    return np.concatenate(priors)
+
+
+def _template_priors(maps, side):
+
+    """
+    Converts template maps to x, y, sigma. side is 1 for the left hemisphere
+    (right visual field), -1 for the right hemisphere.
+    """
+
+    # template angle is 0 at the upper vertical meridian and 90 at the
+    # contralateral horizontal meridian, in both hemispheres
+    angle, eccen = np.radians(maps['angle']), maps['eccen']
+    priors = np.column_stack([side * eccen * np.sin(angle),
+                              eccen * np.cos(angle), maps['sigma']])
+    valid = (maps['varea'] > 0) & (eccen > 0) & (maps['sigma'] > 0)
+    priors[~valid] = np.nan
+    return priors.astype(np.float32)
@@ -0,0 +1,33 @@
+# /usr/bin/python
+"""
+Atomic file writes for caches and outputs that other processes may read
+while they are being written, or that an interrupted run may leave behind.
+"""
+
+import os
+import os.path as op
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+
+    """
+    Opens a temporary file next to path for writing, moving it into place
+    only once the block completes, so path never holds a partial file. The
+    temporary file is removed if the block fails.
+
+    Args:
+        path (str): file to write
+        mode (str): 'wb' or 'w'
+    """
+
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if op.exists(tmp):
+            os.remove(tmp)
@@ -4,9 +4,12 @@ Created by David Coggan on 2023 02 14
 Contains variables and functions that are useful across fMRI experiments
 """
 
+import os.path as op
 import json
 
-PROJ_DIR = 'data'
+# project data directory, next to this repository's utils package, so it is
+# found whatever the working directory (e.g. in pRF worker processes)
+PROJ_DIR = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'data')
 
 # subjects
 subjects = json.load(open(f'{PROJ_DIR}/participants.json', 'r+'))
@@ -16,6 +19,37 @@ scan_params = {
     'retinotopy': {'TR': 2, 'dynamics': 150},
     'restingState': {'TR': 2, 'dynamics': 60}}
 
+# pRF model parameters
+prf_params = {
+    'stim_dir': 'stimuli',  # binary apertures, one frame per TR
+    'stim_radius_deg': 4.5,  # radius of stimulated visual field
+    'aperture_res': 51,  # pixels per side after downsampling apertures
+    'grid_xy': 41,  # candidate pRF centres along each axis
+    'grid_extent': 1.5,  # max pRF centre eccentricity / stimulus radius
+    'grid_sigma': (0.2, 8., 24),  # min, max (deg) and number of pRF sizes
+    'drift_degree': 3,  # polynomial drift regressors per run
+    'refine_iters': 12,  # pattern search iterations after grid search
+    'model': 'gaussian',  # 'gaussian' or 'css' (compressive spatial summation)
+    'css_exponent': (0.1, 1., 8),  # min, max and number of CSS exponents
+    'search': 'full',  # 'full' fine grid or 'coarse_to_fine'
+    'coarse_res': 26,  # aperture resolution for coarse search
+    'coarse_grid_xy': 21,  # coarse pRF centres along each axis
+    'coarse_grid_sigma': 16,  # coarse pRF sizes
+    'local_margin': 1,  # extra fine steps searched around coarse match
+    'prior_radius': (4, 4),  # fine grid steps (xy, sigma) around atlas prior
+    'prior_min_r2': 10,  # seeded fits below this r2 use the full search
+    'chunk_size': 2000,  # voxels per worker task
+    'cache_dir': 'derivatives/pRF/prediction_cache',
+    'cache_max_gb': 4,  # least recently used predictions evicted beyond this
+}
+
+# sampling of functional volumes at cortical surface vertices
+surface_params = {
+    'fractions': (0., .25, .5, .75, 1.),  # white (0) to pial (1) sample points
+    'fsaverage_neighbours': 3,  # subject vertices averaged per fsaverage vertex
+    'smooth_steps': 8,  # neighbour averaging steps for smoothed surface maps
+}
+
 FEAT_designs = {
     'base': {  # common to all FEAT analyses
         # misc
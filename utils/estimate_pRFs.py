@@ -2,102 +2,233 @@
 # Created by David Coggan on 2023 06 28
 import os
 import os.path as op
-import matlab.engine
 import glob
-from . import PROJ_DIR, subjects, MSTR_DIR, scan_params
+import shutil
+import numpy as np
+from .config import PROJ_DIR, subjects, scan_params, prf_params
+from .prf_engine import load_stimulus, fit_prfs, save_prf_maps, \
+    save_prf_surface_maps, cross_validate_prfs
+from .masked_timeseries import load_masked_timeseries, \
+    load_indexed_timeseries
+from .atlas_prior import atlas_priors, surface_atlas_priors
+from .surface_sampling import surface_projection
+from .prepare_timeseries import prepare_session
+from .prefetch import prefetch
 
-def prf(func, mask, out_dir, TR, remove_outliers, stim):
-    eng = matlab.engine.start_matlab()
-    eng.addpath(f'{MSTR_DIR}/fMRI')
-    eng.addpath(eng.genpath(f'/home/tonglab/david/repos/analyzePRF'))
-    eng.addpath(eng.genpath(f'/home/tonglab/david/repos/mrTools-4.8.0.0'))
-    eng.analyzePRF_call(
-        func, mask, out_dir, TR, remove_outliers, stim, nargout=0)
-    eng.quit()
 
+def clip_outliers(data):
 
-def estimate_pRFs():
+    """ Clips spikes to 3.5 SD from the mean along the last (time) axis """
+
+    mean = data.mean(axis=-1, keepdims=True)
+    sd = data.std(axis=-1, keepdims=True)
+    return np.clip(data, mean - 3.5 * sd, mean + 3.5 * sd)
+
+
+def save_results(results, indices, ref, out_dir):
+
+    """
+    Writes volume maps, or surface overlays if ref is None and indices holds
+    the analysed vertices of each hemisphere (see read_session)
+    """
+
+    if ref is None:
+        save_prf_surface_maps(results, indices, out_dir)
+    else:
+        save_prf_maps(results, indices, ref, out_dir)
+
+
+def fit_session(data, indices, ref, out_dir, TR, stim, n_runs=1,
+                num_procs=None, params=prf_params, priors=None):
+
+    """
+    Fits pRFs to masked data that has already been read (voxels or vertices
+    x time, n_runs runs concatenated) and writes the maps to out_dir.
+    Finished chunks of voxels are checkpointed in {out_dir}/checkpoints, so
+    an interrupted fit resumes where it stopped.
+    """
+
+    apertures = load_stimulus(stim)
+    checkpoint_dir = f'{out_dir}/checkpoints'
+    results = fit_prfs(data, apertures, TR, n_runs, num_procs, stim,
+                       params, priors, checkpoint_dir)
+    save_results(results, indices, ref, out_dir)
+    shutil.rmtree(checkpoint_dir)
+
+
+def fit_session_cv(runs, indices, ref, out_dir, TR, stim, num_procs=None,
+                   params=prf_params):
+
+    """
+    Leave-one-run-out cross-validated fit of masked runs (runs x voxels x
+    time) that have already been read. The mean across runs is fit to give
+    the usual outputs and each held-out run is scored against a fit to the
+    remaining runs, giving r2_cv.nii. Checkpointed as for fit_session.
+    """
+
+    apertures = load_stimulus(stim)
+    checkpoint_dir = f'{out_dir}/checkpoints'
+    results, r2_cv = cross_validate_prfs(runs, apertures, TR, num_procs,
+                                         stim, params, checkpoint_dir)
+    results['r2_cv'] = r2_cv
+    save_results(results, indices, ref, out_dir)
+    shutil.rmtree(checkpoint_dir)
+
+
+def prf(funcs, mask, out_dir, TR, remove_outliers, stim, num_procs=None,
+        params=prf_params, priors=None):
+
+    """
+    Fits pRFs (params['model']) to every voxel in mask, replacing the MATLAB
+    analyzePRF call. Multiple functional runs are concatenated in time, each
+    paired with the same stimulus. Writes polar_angle, eccentricity_deg,
+    rfsize_sigma_deg and r2 NIfTIs (plus exponent for the CSS model) and
+    prfs.mat to out_dir. priors optionally seeds the search for each voxel
+    in mask (see atlas_priors).
+    """
+
+    data, indices, ref = load_masked_timeseries(funcs, mask)
+    if remove_outliers:
+        data = clip_outliers(data)
+    fit_session(data, indices, ref, out_dir, TR, stim, len(funcs), num_procs,
+                params, priors)
+
+
+def prf_cv(funcs, mask, out_dir, TR, remove_outliers, stim, num_procs=None,
+           params=prf_params):
+
+    """
+    Leave-one-run-out cross-validated pRF fitting, see fit_session_cv. Each
+    run is read once.
+    """
+
+    data, indices, ref = load_masked_timeseries(funcs, mask)
+    runs = data.reshape(len(indices), len(funcs), -1).transpose(1, 0, 2)
+    if remove_outliers:
+        runs = clip_outliers(runs)
+    fit_session_cv(runs, indices, ref, out_dir, TR, stim, num_procs, params)
+
+
+def read_session(subject, session, cross_validate=False, atlas_prior=False,
+                 surface=False):
+
+    """
+    Prepares a session's timeseries if this has not been done, then reads
+    the voxels inside the analysis mask with outliers clipped. Called on the
+    prefetch thread while the previous session is being fit. If surface,
+    the timeseries are instead projected onto the cortical surface vertices
+    that sample the analysis mask, and only the voxels they sample are read.
+
+    Returns:
+        data (np.ndarray): voxels (or vertices) x time mean timeseries, or
+            runs x voxels x time if cross_validate
+        indices (np.ndarray): flat voxel indices of the mask, or if surface,
+            a dict of hemi -> (analysed vertices, number of vertices)
+        ref (nib.Nifti1Image): the mask image, for writing results, or None
+            if surface
+        priors (np.ndarray): template retinotopy priors if atlas_prior,
+            else None
+    """
+
+    mask = f'derivatives/ROIs/sub-{subject}/{session}/mask_analyzed.nii.gz'
+    ref_func = glob.glob(f'derivatives/registration/sub-{subject}/'
+                         f'{session}/example_func.nii*')[0]
+    sess_dir = f'derivatives/pRF/sub-{subject}/{session}'
+
+    # get timeseries, ensure alignment to ref func and no drift
+    funcs = sorted(glob.glob(
+        f'derivatives/fmriprep-*/sub-{subject}/'
+        f'{session}/func/*task-retinotopy*bold.nii*'))
+    mean_func = f'{sess_dir}/mean_before_prf/timeseries.nii.gz'
+    need_runs = cross_validate and not len(glob.glob(
+        f'{sess_dir}/timeseries_run-*.nii.gz'))
+    if not op.isfile(mean_func) or need_runs:
+        prepare_session(funcs, ref_func, sess_dir, keep_runs=cross_validate)
+
+    if cross_validate:
+        funcs = sorted(glob.glob(f'{sess_dir}/timeseries_run-*.nii.gz'))
+    else:
+        funcs = [mean_func]
+    if surface:
+        indices, projection, columns = surface_projection(
+            subject, session, mask)
+        data = projection @ load_indexed_timeseries(funcs, columns)
+        ref = None
+    else:
+        data, indices, ref = load_masked_timeseries(funcs, mask)
+    if cross_validate:
+        data = data.reshape(len(data), len(funcs), -1).transpose(1, 0, 2)
+    data = clip_outliers(data)
+    priors = None
+    if atlas_prior and surface:
+        priors = surface_atlas_priors(subject, indices)
+    elif atlas_prior:
+        priors = atlas_priors(subject, session, indices)
+    return data, indices, ref, priors
+
+
+def estimate_pRFs(num_procs=None, search='full', cross_validate=False,
+                  atlas_prior=False, model='gaussian', prefetch_depth=1,
+                  surface=False):
+
+    """
+    Fits each session in turn. While one session is fit, the next is
+    prepared and read on a background thread (see read_session).
+
+    Args:
+        num_procs (int): worker processes for fitting, defaults to all cores
+        search (str): 'full' searches the whole fine grid, 'coarse_to_fine'
+            matches a coarse grid first then searches locally on the fine grid
+        cross_validate (bool): fit the mean across runs directly from the
+            run timeseries and add a leave-one-run-out r2_cv map
+        atlas_prior (bool): seed each voxel's search with template
+            retinotopy from neuropythy, searching only the surrounding grid
+        model (str): 'gaussian', or 'css' for compressive spatial summation
+            with a fitted exponent (written to exponent.nii)
+        prefetch_depth (int): sessions read ahead of the one being fit
+        surface (bool): fit the timeseries projected onto the cortical
+            surface vertices rather than the volume, writing *_lh.mgh and
+            *_rh.mgh maps to mean_before_prf_surface
+    """
 
     print('Estimating pRFs...')
     TR = scan_params['retinotopy']['TR']
+    params = dict(prf_params, search=search, model=model)
+    fit_dir = 'mean_before_prf_surface' if surface else 'mean_before_prf'
+    sessions_to_fit = []
     for subject, sessions in subjects.items():
-        stim = 'wedge_ring' if subject != 'F019' else 'multibar'
         for session in sessions:
 
-            mask = (f'derivatives/ROIs/sub-{subject}/{session}/'
-                    f'mask_analyzed.nii.gz')
-            ref_func = glob.glob(f'derivatives/registration/sub-{subject}/'
-                        f'{session}/example_func.nii*')[0]
             sess_dir = f'derivatives/pRF/sub-{subject}/{session}'
             os.makedirs(sess_dir, exist_ok=True)
+            # analyze mean timeseries across all runs in session (prfs.mat
+            # is only written once all maps are complete)
+            out_dir = f'{sess_dir}/{fit_dir}'
+            done = op.isfile(f'{out_dir}/prfs.mat')
+            if cross_validate:  # prfs.mat may be from a fit without CV
+                cv_maps = [f'r2_cv_{hemi}.mgh' for hemi in ['lh', 'rh']] \
+                    if surface else ['r2_cv.nii']
+                done &= all(op.isfile(f'{out_dir}/{m}') for m in cv_maps)
+            if not done:
+                sessions_to_fit.append((subject, session))
+
+    # fit each session while the next is read in the background
+    def read(subject_session):
+        return read_session(*subject_session, cross_validate, atlas_prior,
+                            surface)
+
+    for (subject, session), (data, indices, ref, priors) in prefetch(
+            read, sessions_to_fit, prefetch_depth):
+        stim = 'wedge_ring' if subject != 'F019' else 'multibar'
+        out_dir = f'derivatives/pRF/sub-{subject}/{session}/{fit_dir}'
+        print(f'Fitting pRFs for sub-{subject} {session}...')
+        if cross_validate:
+            fit_session_cv(data, indices, ref, out_dir, TR, stim, num_procs,
+                           params)
+        else:
+            fit_session(data, indices, ref, out_dir, TR, stim, 1, num_procs,
+                        params, priors)
 
-            # get timeseries, ensure alignment to ref func and no drift
-            funcs = sorted(glob.glob(
-                f'derivatives/fmriprep-*/sub-{subject}/'
-                f'{session}/func/*task-retinotopy*bold.nii*'))
-            for func in funcs:
-                run = func.split('_')[-3]
-                func_local = f'{sess_dir}/timeseries_{run}.nii.gz'
-                if not op.isfile(func_local):
-                    # align run to reference functional volume
-                    os.system(f'mcflirt -in {func} -reffile {ref_func} -out '
-                              f'{func_local}')
-                    # linear trend removal
-                    tmean = f'{func_local.replace(".nii", "_tmean.nii")}'
-                    os.system(f'fslmaths {func_local} -Tmean {tmean}')
-                    os.system(f'fslmaths {func_local} -bptf 60 -1 '
-                              f'-add {tmean} -nan {func_local}')
-                    os.remove(tmean)
-            """
-            # option 1: analyze separately for each run
-            funcs = sorted(glob.glob(f'{sess_dir}/timeseries_run*.nii.gz'))
-            funcs = [op.abspath(f) for f in funcs]
-            if not op.isfile(f'{sess_dir}/prfs.mat'):
-                prf(funcs, mask, sess_dir, TR, True, stim)
-            """
-            # option 2: analyze mean timeseries across all runs in session
-            out_dir = f'{sess_dir}/mean_before_prf'
-            os.makedirs(out_dir, exist_ok=True)
-            func = f'{out_dir}/timeseries.nii.gz'
-            if not op.isfile(func):
-                funcs = glob.glob(f'{sess_dir}/timeseries_run-*.nii.gz')
-                os.system(f'fslmaths {" -add ".join(funcs)} -div '
-                          f'{len(funcs)} {func}')
-            if not op.isfile(f'{out_dir}/prfs.mat'):
-                prf([func], mask, out_dir, TR, True, stim)
-            """
-            # option 3: analyze concatenated timeseries across all runs in session
-            out_dir = f'{sess_dir}/concatenated_before_prf'
-            os.makedirs(out_dir, exist_ok=True)
-            func_concat = f'{out_dir}/timeseries.nii.gz'
-            if not op.isfile(func_concat):
-
-                # get mean func across all runs
-                mean_func_all = f'{out_dir}/timeseries_all_mean.nii.gz'
-                os.system(f'fslmaths '
-                          f'{sess_dir}/mean_before_prf/timeseries.nii.gz '
-                          f'-Tmean {mean_func_all}')
-
-                # replace the mean func of each run with mean func of all runs
-                funcs = sorted(glob.glob(f'{sess_dir}/timeseries_run-*.nii.gz'))
-                for func in funcs:
-                    mean_func = func.replace(sess_dir, out_dir)
-                    mean_func = mean_func.replace('.nii.gz', '_mean.nii.gz')
-                    os.system(f'fslmaths {func} -Tmean {mean_func}')
-                    demeaned_func = mean_func.replace('_mean', '_demeaned')
-                    os.system(f'fslmaths {func} -sub {mean_func} {demeaned_func}')
-                    remeaned_func = demeaned_func.replace('demean', 'remean')
-                    os.system(f'fslmaths {demeaned_func} -add {mean_func_all} '
-                              f'{remeaned_func}')
-                remeaned_funcs = sorted(glob.glob(
-                    f'{out_dir}/timeseries_*_remeaned.nii.gz'))
-                os.system(f'fslmerge -t {func_concat} {" ".join(remeaned_funcs)}')
-                files_to_remove = glob.glob(f'{out_dir}/timeseries_*.nii.gz')
-                for f in files_to_remove:
-                    os.remove(f)
-                if not op.isfile(f'{out_dir}/prfs.mat'):
-                    prf([func_concat], mask, out_dir, TR, True, stim)
-                """
 
 if __name__ == "__main__":
     os.chdir(PROJ_DIR)
@@ -0,0 +1,217 @@
+# /usr/bin/python
+"""
+Visual field sign and draft early visual area labels. The field sign of
+each face of the spherical surface is the sign of the Jacobian determinant
+of (polar angle, eccentricity) with respect to position on the surface,
+computed with sparse per-face gradient operators that are built once per
+subject and hemisphere. Adjacent early visual areas have opposite signs, so
+starting from the Wang et al. (2015) atlas areas, each area is grown across
+the vertices whose sign matches it until it meets a sign reversal. The
+resulting labels are drafts, to be checked with create_retinotopy_labels.py
+before use.
+"""
+
+import os
+import os.path as op
+import glob
+import numpy as np
+import nibabel as nib
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from .config import PROJ_DIR
+from .labels import write_label
+from .surface_smoothing import smoothing_operator
+from .surface_sampling import save_mgh
+from .get_wang_atlas import WANG_ROIS
+from .atomic import atomic_write
+
+AREAS = ['V1v', 'V1d', 'V2v', 'V2d', 'V3v', 'V3d']
+MIN_R2 = 10  # vertices below this r2 are not labelled, as mask_r2_thresh
+GROW_RINGS = 10  # neighbour rings an area may grow beyond its atlas label
+
+
+def gradient_operators(subject, hemi):
+
+    """
+    Sparse operators giving, for each face of the sphere, the gradient of a
+    vertex map in a basis (u, v) of the face's plane, stacked as
+    (2 x faces) x vertices, plus the faces x vertices operator averaging the
+    face's vertices. Stored as surf/{hemi}.sphere.gradient.npz in the
+    subject's freesurfer directory, rebuilt if the sphere has changed.
+    """
+
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    surface = f'{fs_subj_dir}/surf/{hemi}.sphere'
+    path = f'{fs_subj_dir}/surf/{hemi}.sphere.gradient.npz'
+    coords, faces = nib.freesurfer.read_geometry(surface)
+    num_faces, num_vertices = len(faces), len(coords)
+    rows = np.repeat(np.arange(num_faces), 3)
+    mean = scipy.sparse.csr_matrix(
+        (np.full(3 * num_faces, 1 / 3, dtype=np.float32),
+         (rows, faces.ravel())), shape=(num_faces, num_vertices))
+    if op.isfile(path) and op.getmtime(path) >= op.getmtime(surface):
+        return scipy.sparse.load_npz(path), mean
+
+    p0, p1, p2 = [coords[faces[:, i]] for i in range(3)]
+    normal = np.cross(p1 - p0, p2 - p0)
+    twice_area = np.linalg.norm(normal, axis=1, keepdims=True)
+    normal /= twice_area
+    u = (p1 - p0) / np.linalg.norm(p1 - p0, axis=1, keepdims=True)
+    v = np.cross(normal, u)
+
+    # gradient of vertex i's linear basis function: normal x opposite edge
+    basis = [np.cross(normal, p2 - p1), np.cross(normal, p0 - p2),
+             np.cross(normal, p1 - p0)]
+    basis = np.stack(basis, axis=1) / twice_area[:, None]  # faces x 3 x 3
+    weights = np.concatenate([(basis * u[:, None]).sum(axis=2).ravel(),
+                              (basis * v[:, None]).sum(axis=2).ravel()])
+    gradient = scipy.sparse.csr_matrix(
+        (weights.astype(np.float32),
+         (np.concatenate([rows, rows + num_faces]),
+          np.tile(faces.ravel(), 2))), shape=(2 * num_faces, num_vertices))
+    with atomic_write(path) as f:
+        scipy.sparse.save_npz(f, gradient)
+    return gradient, mean
+
+
+def field_sign(polar_angle, eccentricity, gradient, mean):
+
+    """
+    Visual field sign of each vertex, the mean sign of its faces (-1 to 1).
+
+    Args:
+        polar_angle (np.ndarray): degrees, at each vertex
+        eccentricity (np.ndarray): at each vertex
+        gradient, mean (scipy.sparse.csr_matrix): see gradient_operators
+    """
+
+    num_faces = mean.shape[0]
+    z = np.exp(1j * np.radians(np.nan_to_num(polar_angle)))
+    z_face = mean @ z
+    grad_z = (gradient @ z).reshape(2, num_faces)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d_angle = np.imag(np.conj(z_face) * grad_z) / np.abs(z_face) ** 2
+    d_ecc = (gradient @ np.nan_to_num(eccentricity)).reshape(2, num_faces)
+    sign = np.sign(d_angle[0] * d_ecc[1] - d_angle[1] * d_ecc[0])
+    sign[~np.isfinite(sign)] = 0
+    incidence = (mean.T > 0).astype(np.float32)
+    return (incidence @ sign) / np.maximum(incidence.sum(axis=1).A1, 1)
+
+
+def grow_areas(seeds, allowed, adjacency, rings=GROW_RINGS):
+
+    """
+    Grows areas from seed vertices into neighbouring allowed vertices, all
+    areas one ring at a time, a vertex joining the area with most
+    neighbours in it. Each area keeps only its largest connected part.
+
+    Args:
+        seeds (np.ndarray): area number (1, 2...) of each vertex, 0 if none
+        allowed (np.ndarray): vertices x areas, whether each area may
+            include each vertex
+        adjacency (scipy.sparse.csr_matrix): vertex neighbours
+
+    Returns:
+        areas (np.ndarray): area number of each vertex, 0 if none
+    """
+
+    num_areas = allowed.shape[1]
+    areas = np.where(allowed[np.arange(len(seeds)), seeds - 1] & (seeds > 0),
+                     seeds, 0)
+    for _ in range(rings):
+        members = scipy.sparse.csr_matrix(
+            (np.ones(np.count_nonzero(areas)), (np.flatnonzero(areas),
+                                                areas[areas > 0] - 1)),
+            shape=(len(areas), num_areas))
+        votes = (adjacency @ members).toarray() * allowed
+        grow = (areas == 0) & (votes.max(axis=1) > 0)
+        if not grow.any():
+            break
+        areas[grow] = votes[grow].argmax(axis=1) + 1
+
+    for area in range(1, num_areas + 1):
+        vertices = np.flatnonzero(areas == area)
+        if len(vertices):
+            parts = connected_components(
+                adjacency[vertices][:, vertices], directed=False)[1]
+            largest = np.bincount(parts).argmax()
+            areas[vertices[parts != largest]] = 0
+    return areas
+
+
+def draft_labels(subject, session, prf_dir, overwrite=False):
+
+    """
+    Writes field_sign_{hemi}.mgh to prf_dir and draft labels
+    {hemi}.tong_draft.{area}.label (V1v, V1d, V2v, V2d, V3v, V3d and V1) to
+    the session's ROI directory.
+
+    Args:
+        subject (str): subject ID, without the 'sub-' prefix
+        session (str): session directory name
+        prf_dir (str): directory with the surface pRF maps
+    """
+
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    roi_dir = f'derivatives/ROIs/sub-{subject}/{session}'
+    for hemi in ['lh', 'rh']:
+        out = f'{roi_dir}/{hemi}.tong_draft.V1.label'
+        if op.isfile(out) and not overwrite:
+            continue
+        maps = {}
+        for name in ['polar_angle', 'eccentricity_deg', 'r2']:
+            path = f'{prf_dir}/{name}_smoothed_{hemi}.mgh'
+            if name == 'r2' or not op.isfile(path):
+                path = f'{prf_dir}/{name}_{hemi}.mgh'
+            maps[name] = np.asarray(nib.load(path).dataobj).ravel()
+
+        gradient, mean = gradient_operators(subject, hemi)
+        sign = field_sign(maps['polar_angle'], maps['eccentricity_deg'],
+                          gradient, mean)
+        save_mgh(sign, f'{prf_dir}/field_sign_{hemi}.mgh')
+
+        # atlas areas as seeds, V1 and V3 sharing a sign opposite to V2's
+        atlas = np.asarray(nib.load(
+            f'{fs_subj_dir}/surf/{hemi}.wang15_mplbl.mgz').dataobj).ravel()
+        atlas_ids = [WANG_ROIS.index(area) + 1 for area in AREAS]
+        seeds = np.zeros(len(atlas), dtype=int)
+        for a, atlas_id in enumerate(atlas_ids):
+            seeds[atlas == atlas_id] = a + 1
+        valid = np.nan_to_num(maps['r2'], nan=-np.inf) >= MIN_R2
+        v1_sign = np.sign(sign[valid & (seeds > 0) & (seeds <= 2)].sum())
+        expected = np.array([1, 1, -1, -1, 1, 1]) * v1_sign
+        allowed = valid[:, None] & (np.sign(sign)[:, None] == expected)
+
+        adjacency = smoothing_operator(subject, hemi)
+        areas = grow_areas(seeds, allowed, adjacency)
+        os.makedirs(roi_dir, exist_ok=True)
+        for a, area in enumerate(AREAS):
+            write_label(f'{roi_dir}/{hemi}.tong_draft.{area}.label',
+                        np.flatnonzero(areas == a + 1), subject, hemi)
+        write_label(out, np.flatnonzero((areas == 1) | (areas == 2)),
+                    subject, hemi)
+
+
+def draft_visual_labels(fit_dir='mean_before_prf', overwrite=False):
+
+    """ draft_labels for every session with surface pRF maps """
+
+    for prf_dir in sorted(glob.glob(f'derivatives/pRF/sub-*/*/{fit_dir}')):
+        subject = prf_dir.split('/')[2].split('-')[1]
+        fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+        if not all(op.isfile(f'{prf_dir}/{name}_{hemi}.mgh') for name in
+                   ['polar_angle', 'eccentricity_deg', 'r2']
+                   for hemi in ['lh', 'rh']):
+            continue
+        if not all(op.isfile(f'{fs_subj_dir}/surf/{hemi}.wang15_mplbl.mgz')
+                   for hemi in ['lh', 'rh']):
+            print(f'No Wang atlas for sub-{subject}, skipping draft labels')
+            continue
+        session = prf_dir.split('/')[3]
+        print(f'Drafting visual area labels for sub-{subject} {session}...')
+        draft_labels(subject, session, prf_dir, overwrite)
+
+
+if __name__ == "__main__":
+    os.chdir(PROJ_DIR)
+    draft_visual_labels()
@@ -0,0 +1,131 @@
+# /usr/bin/python
+"""
+Resampling of surface pRF maps onto fsaverage. Each fsaverage vertex takes
+an inverse-distance weighted average of its nearest subject vertices on the
+registered spheres (?h.sphere.reg). The neighbour indices and weights are
+found once per subject and hemisphere with a KD-tree and stored, so any
+number of maps are then resampled with one gather. Polar angle is averaged
+as unit vectors.
+"""
+
+import os
+import os.path as op
+import glob
+import numpy as np
+import nibabel as nib
+from scipy.spatial import cKDTree
+from .config import PROJ_DIR, surface_params
+from .surface_sampling import save_mgh
+from .atomic import atomic_write
+
+
+def fsaverage_index(subject, hemi,
+                    k=surface_params['fsaverage_neighbours']):
+
+    """
+    Nearest subject vertices of each fsaverage vertex, stored as
+    surf/{hemi}.fsaverage_index.npz in the subject's freesurfer directory
+    and recomputed if either sphere.reg has changed since.
+
+    Args:
+        subject (str): subject ID, without the 'sub-' prefix
+        hemi (str): 'lh' or 'rh'
+        k (int): neighbours per fsaverage vertex
+
+    Returns:
+        indices (np.ndarray): fsaverage vertices x k subject vertices
+        weights (np.ndarray): fsaverage vertices x k, rows summing to 1
+    """
+
+    fs_dir = os.environ['SUBJECTS_DIR']
+    sphere = f'{fs_dir}/sub-{subject}/surf/{hemi}.sphere.reg'
+    target = f'{fs_dir}/fsaverage/surf/{hemi}.sphere.reg'
+    path = f'{fs_dir}/sub-{subject}/surf/{hemi}.fsaverage_index.npz'
+    if op.isfile(path) and op.getmtime(path) >= max(
+            op.getmtime(sphere), op.getmtime(target)):
+        stored = np.load(path)
+        if stored['indices'].shape[1] == k:
+            return stored['indices'], stored['weights']
+
+    coords = nib.freesurfer.read_geometry(sphere)[0]
+    distances, indices = cKDTree(coords).query(
+        nib.freesurfer.read_geometry(target)[0], k=k)
+    indices, distances = indices.reshape(len(indices), k), \
+        distances.reshape(len(distances), k)
+    weights = 1 / np.maximum(distances, 1e-6)
+    weights /= weights.sum(axis=1, keepdims=True)
+    with atomic_write(path) as f:
+        np.savez(f, indices=indices.astype(np.int32),
+                 weights=weights.astype(np.float32))
+    return indices.astype(np.int32), weights.astype(np.float32)
+
+
+def to_fsaverage(values, indices, weights, circular=False):
+
+    """
+    Weighted average of each fsaverage vertex's neighbours, ignoring NaNs.
+
+    Args:
+        values (np.ndarray): subject vertices (x maps)
+        indices, weights (np.ndarray): see fsaverage_index
+        circular (bool): values are angles in degrees, averaged as unit
+            vectors
+
+    Returns:
+        resampled (np.ndarray): fsaverage vertices (x maps), NaN where no
+            neighbour has a value
+    """
+
+    gathered = np.asarray(values)[indices]  # fsaverage vertices x k (x maps)
+    w = weights.reshape(weights.shape + (1,) * (gathered.ndim - 2))
+    valid = np.isfinite(gathered)
+    w = np.where(valid, w, 0)
+    if circular:
+        gathered = np.exp(1j * np.radians(np.where(valid, gathered, 0)))
+    total = (w * np.where(valid, gathered, 0)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if circular:
+            resampled = np.degrees(np.angle(total)) % 360
+        else:
+            resampled = total / w.sum(axis=1)
+    return np.where(w.sum(axis=1) > 0, resampled, np.nan).astype(np.float32)
+
+
+def fsaverage_maps(fit_dir='mean_before_prf', overwrite=False):
+
+    """
+    Writes each session's {map}_{hemi}.mgh surface maps resampled to
+    fsaverage in {fit_dir}/fsaverage, all maps of a hemisphere in one
+    gather.
+    """
+
+    fs_dir = os.environ['SUBJECTS_DIR']
+    for prf_dir in sorted(glob.glob(f'derivatives/pRF/sub-*/*/{fit_dir}')):
+        subject = prf_dir.split('/')[2].split('-')[1]
+        out_dir = f'{prf_dir}/fsaverage'
+        for hemi in ['lh', 'rh']:
+            surfaces = sorted(glob.glob(f'{prf_dir}/*_{hemi}.mgh'))
+            surfaces = [s for s in surfaces if overwrite or not op.isfile(
+                f'{out_dir}/{op.basename(s)}')]
+            if not surfaces or not op.isfile(
+                    f'{fs_dir}/sub-{subject}/surf/{hemi}.sphere.reg'):
+                continue
+            print(f'Resampling {prf_dir} {hemi} maps to fsaverage...')
+            os.makedirs(out_dir, exist_ok=True)
+            indices, weights = fsaverage_index(subject, hemi)
+            maps = np.column_stack([np.asarray(nib.load(s).dataobj).ravel()
+                                    for s in surfaces])
+            angles = np.array(['polar_angle' in s for s in surfaces])
+            resampled = np.empty((len(indices), len(surfaces)),
+                                 dtype=np.float32)
+            resampled[:, ~angles] = to_fsaverage(maps[:, ~angles], indices,
+                                                 weights)
+            resampled[:, angles] = to_fsaverage(maps[:, angles], indices,
+                                                weights, circular=True)
+            for surface, values in zip(surfaces, resampled.T):
+                save_mgh(values, f'{out_dir}/{op.basename(surface)}')
+
+
+if __name__ == "__main__":
+    os.chdir(PROJ_DIR)
+    fsaverage_maps()
@@ -1,22 +1,60 @@
-
 import os
 import os.path as op
 import glob
 import json
+import numpy as np
+import nibabel as nib
+from .labels import write_label
+from .surface_sampling import vertex_voxels
+from .atlas_prior import RIBBON_LABELS
+from concurrent.futures import ThreadPoolExecutor
+
+WANG_ROIS = (
+    "V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4", "VO1", "VO2",
+    "PHC1", "PHC2", "TO2", "TO1", "LO2", "LO1", "V3B", "V3A",
+    "IPS0", "IPS1", "IPS2", "IPS3", "IPS4", "IPS5", "SPL1", "FEF")
 
-def get_wang_atlas(subject):
+# one container runs the neuropythy atlas command for every subject listed
+# after it, importing neuropythy once. A subject that fails is reported and
+# the rest still run; the container then exits non-zero. {fs_dir} is
+# replaced with the freesurfer subjects dir
+NEUROPYTHY_SCRIPT = """
+import sys
+from neuropythy.commands import atlas
+failed = []
+for subject in sys.argv[1:]:
+    try:
+        if atlas.main(['--verbose', subject]):
+            failed.append(subject)
+    except (Exception, SystemExit) as error:
+        print('neuropythy atlas failed for', subject, error)
+        failed.append(subject)
+if failed:
+    sys.exit('neuropythy atlas failed for: ' + ' '.join(failed))
+"""
+NEUROPYTHY_CMD = (
+    'docker run --rm --mount type=bind,src={fs_dir},dst=/subjects '
+    '--env "NPYTHYRC=/subjects/.npythyrc" --entrypoint python nben/neuropythy '
+    f'-c "{NEUROPYTHY_SCRIPT}"')
+
+# fractions of cortical thickness sampled when filling the ribbon
+RIBBON_FRACTIONS = np.linspace(0, 1, 11)
+
+
+def neuropythy_atlas(subjects, num_containers=1, command=NEUROPYTHY_CMD):
 
     """
-    Obtain the probabilistic atlas of retinotopic regions from Wang et al.
-    2015 using Noah Benson's neuropythy package. It will also convert the
-    atlas to individual surface labels and volumetric ROIs in the original
-    anatomical space. This function requires docker, configured to run
-    without super-user permissions, as installing neuropythy natively causes
-    dependency conflicts with other scripts. Before running, ensure docker
-    has permissions to write to their freesurfer subjects directory. The
-    surest/easiest way to do this is to change permissions of the freesurfer
-    subjects directory to allow all users to read and write, including
-    sub-files/folders.
+    Runs the neuropythy atlas command for each subject that is still missing
+    surf/??.wang15_mplbl.mgz, with the subjects shared between
+    num_containers concurrent container runs rather than one run per
+    subject.
+
+    Args:
+        subjects (list): freesurfer subject names, e.g. ['sub-F019']
+        num_containers (int): number of containers run at once
+        command (str): command that is followed by the subject names, e.g.
+            a local stand-in for testing. {fs_dir} is replaced with the
+            freesurfer subjects directory.
     """
 
     fs_dir = os.getenv('SUBJECTS_DIR')
@@ -29,59 +67,128 @@ def get_wang_atlas(subject):
     if not op.isfile(npythyrc_path):
         json.dump(neuropythy_params, open(npythyrc_path, 'w+'))
 
-    roiname_array = (
-    "V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4", "VO1", "VO2",
-    "PHC1", "PHC2", "TO2", "TO1", "LO2", "LO1", "V3B", "V3A",
-    "IPS0", "IPS1", "IPS2", "IPS3", "IPS4", "IPS5", "SPL1", "FEF")
+    todo = [subject for subject in subjects if len(glob.glob(
+        f"{fs_dir}/{subject}/surf/??.wang15_mplbl.mgz")) < 2]
+    if not todo:
+        return
+    print(f'Running neuropythy atlas for {len(todo)} subject(s)...')
+    command = command.replace('{fs_dir}', fs_dir)
+    batches = [todo[b::num_containers] for b in range(num_containers)]
+    batches = [batch for batch in batches if batch]
+    with ThreadPoolExecutor(num_containers) as pool:
+        statuses = list(pool.map(os.system, [f'{command} {" ".join(batch)}'
+                                             for batch in batches]))
+    failed = [subject for batch, status in zip(batches, statuses) if status
+              for subject in batch if len(glob.glob(
+                  f"{fs_dir}/{subject}/surf/??.wang15_mplbl.mgz")) < 2]
+    if failed:
+        print(f'neuropythy atlas failed for: {" ".join(failed)}')
+
+
+def get_wang_atlas(subject, roi_volumes=False, run_atlas=True):
+
+    """
+    Obtain the probabilistic atlas of retinotopic regions from Wang et al.
+    2015 using Noah Benson's neuropythy package. It will also convert the
+    atlas to individual surface labels and a volumetric ROI map in the
+    original anatomical space. This function requires docker, configured to
+    run without super-user permissions, as installing neuropythy natively
+    causes dependency conflicts with other scripts. Before running, ensure
+    docker has permissions to write to their freesurfer subjects directory.
+    The surest/easiest way to do this is to change permissions of the
+    freesurfer subjects directory to allow all users to read and write,
+    including sub-files/folders.
+
+    Each hemisphere's atlas is read once and split into all ROI labels
+    together. The volumetric map, mri/{hemi}.wang15_mplbl.nii.gz, holds the
+    ROI number (position in WANG_ROIS + 1) of each voxel in the cortical
+    ribbon, filled by sampling each vertex from the white to the pial
+    surface. Single-ROI volumes are made from it on request, see
+    wang_roi_volume. For a cohort, call neuropythy_atlas with all subjects
+    first so they share container runs.
+
+    Args:
+        subject (str): freesurfer subject name, e.g. 'sub-F019'
+        roi_volumes (bool): also write mri/{hemi}.wang15_mplbl.{roi}.nii.gz
+            for every ROI
+        run_atlas (bool): run neuropythy if the atlas is missing, False if
+            neuropythy_atlas has already been run for this subject
+
+    Returns:
+        done (bool): False if neuropythy did not produce the atlas, in which
+            case nothing is written
+    """
 
-    # Get atlas as mgz
-    if len(glob.glob(f"{fs_dir}/{subject}/surf/??.wang15_mplbl.mgz")) < 2:
-        os.system(f'docker run --rm '
-                  f'--mount type=bind,src={fs_dir},dst=/subjects '
-                  f'--env "NPYTHYRC=/subjects/.npythyrc" '
-                  f'nben/neuropythy '
-                  f'atlas --verbose {subject}')
+    fs_dir = os.getenv('SUBJECTS_DIR')
+    if run_atlas:
+        neuropythy_atlas([subject])  # automatically skips if done
+    missing = [hemi for hemi in ['lh', 'rh'] if not op.isfile(
+        f"{fs_dir}/{subject}/surf/{hemi}.wang15_mplbl.mgz")]
+    if missing:
+        print(f'Warning: no neuropythy atlas for {subject} '
+              f'({", ".join(missing)}), skipping Wang atlas ROIs')
+        return False
 
+    subject_id = subject.replace('sub-', '', 1)
+    orig_path = f"{fs_dir}/{subject}/mri/orig.mgz"
     for hemi in ['lh', 'rh']:
 
-        # Convert to labels for all regions
+        # Convert to labels for all regions, storing the region number
         mgz = f"{fs_dir}/{subject}/surf/{hemi}.wang15_mplbl.mgz"
+        atlas = np.asarray(nib.load(mgz).dataobj).ravel().astype(int)
         label = f"{fs_dir}/{subject}/label/{hemi}.wang15_mplbl.label"
         if not op.isfile(label):
-            os.system(f"mri_cor2label "
-                      f"--i {mgz} "
-                      f"--stat "
-                      f"--l {label} "
-                      f"--surf {subject} {hemi}")
-
-        # separate files for each region
-        for r, roiname in enumerate(roiname_array):
+            vertices = np.flatnonzero(atlas)
+            write_label(label, vertices, subject_id, hemi, atlas[vertices])
 
-            # label
+        # separate labels for each region, from one comparison
+        in_roi = atlas[:, None] == np.arange(1, len(WANG_ROIS) + 1)
+        for r, roiname in enumerate(WANG_ROIS):
             label = f"{fs_dir}/{subject}/label/{hemi}.wang15_mplbl.{roiname}.label"
             if not op.isfile(label):
-                os.system(
-                    f"mri_cor2label "
-                    f"--i {mgz} "
-                    f"--id {r + 1} "
-                    f"--l {label} "
-                    f"--surf {subject} {hemi}")
-
-            # nifti with filled cortical ribbon
-            nifti = (f"{fs_dir}/{subject}/mri/{hemi}.wang15_mplbl."
-                     f"{roiname}.nii.gz")
-            if not op.isfile(nifti):
-                os.system(
-                    f"mri_label2vol "
-                    f"--label {label} "
-                    f"--temp {fs_dir}/{subject}/mri/orig.mgz "
-                    f"--o {nifti} "
-                    f"--fill-ribbon "
-                    f"--regheader {fs_dir}/{subject}/mri/orig.mgz "
-                    f"--subject {subject} "
-                    f"--hemi {hemi}")
+                write_label(label, np.flatnonzero(in_roi[:, r]), subject_id,
+                            hemi)
 
-if __name__ == "__main__":
-    get_wang_atlas(f'sub-F019_mprage')
+        # all regions in one volume with filled cortical ribbon
+        nifti = f"{fs_dir}/{subject}/mri/{hemi}.wang15_mplbl.nii.gz"
+        if not op.isfile(nifti):
+            orig = nib.load(orig_path)
+            ribbon = np.asarray(nib.load(
+                f"{fs_dir}/{subject}/mri/ribbon.mgz").dataobj).ravel(order='F')
+            vertices = np.flatnonzero(atlas)
+            voxels = vertex_voxels(subject_id, hemi, orig_path, None,
+                                   RIBBON_FRACTIONS)[vertices].ravel()
+            rois = np.repeat(atlas[vertices], len(RIBBON_FRACTIONS))
+            volume = np.zeros(len(ribbon), dtype=np.uint8)
+            volume[voxels[voxels >= 0]] = rois[voxels >= 0]
+            volume[ribbon != RIBBON_LABELS[hemi]] = 0
+            nib.save(nib.Nifti1Image(volume.reshape(orig.shape, order='F'),
+                                     orig.affine), nifti)
+
+        if roi_volumes:
+            for roiname in WANG_ROIS:
+                wang_roi_volume(subject, hemi, roiname)
+    return True
 
 
+def wang_roi_volume(subject, hemi, roiname):
+
+    """
+    Single-ROI volume in the original anatomical space, made from the
+    multi-region volume written by get_wang_atlas if it does not exist yet.
+
+    Returns:
+        nifti (str): path to mri/{hemi}.wang15_mplbl.{roiname}.nii.gz
+    """
+
+    mri_dir = f"{os.getenv('SUBJECTS_DIR')}/{subject}/mri"
+    nifti = f"{mri_dir}/{hemi}.wang15_mplbl.{roiname}.nii.gz"
+    if not op.isfile(nifti):
+        atlas = nib.load(f"{mri_dir}/{hemi}.wang15_mplbl.nii.gz")
+        roi = np.asarray(atlas.dataobj) == WANG_ROIS.index(roiname) + 1
+        nib.save(nib.Nifti1Image(roi.astype(np.uint8), atlas.affine), nifti)
+    return nifti
+
+
+if __name__ == "__main__":
+    get_wang_atlas(f'sub-F019_mprage')
@@ -0,0 +1,127 @@
+# /usr/bin/python
+"""
+Group pRF maps in MNI152 2 mm space. Each session's volumetric maps are
+resampled into standard space through its registrations (see
+transforms.transform_volumes) and added to running sums, so only one
+session is held in memory at a time. The sums are stored with the list of
+sessions they include, and new sessions are added to them without
+revisiting the others.
+"""
+
+import os
+import os.path as op
+import glob
+import numpy as np
+import nibabel as nib
+from .config import PROJ_DIR
+from .transforms import transform_volumes, space_image
+from .atomic import atomic_write
+
+MAPS = ['polar_angle', 'eccentricity_deg', 'rfsize_sigma_deg', 'r2']
+MIN_WEIGHT = .5  # fraction of a standard voxel that must be analysed
+
+
+def session_sums(subject, session, fit_dir):
+
+    """
+    One session's contribution to the group sums, in standard space.
+    Maps are resampled together with their analysed mask, so NaNs outside
+    the mask do not spread, and polar angle is resampled as cos and sin.
+
+    Returns:
+        sums (dict): name -> standard space array. 'count' is 1 where the
+            session has data, the maps are summed values there and polar
+            angle is split into 'polar_angle_cos' and 'polar_angle_sin'.
+    """
+
+    maps = {name: nib.load(f'{fit_dir}/{name}.nii') for name in MAPS}
+    ref = maps['r2']
+    valid = np.isfinite(ref.get_fdata(dtype=np.float32))
+    volumes = {'weight': valid.astype(np.float32)}
+    for name, img in maps.items():
+        values = np.where(valid, img.get_fdata(dtype=np.float32), 0)
+        if name == 'polar_angle':
+            volumes['polar_angle_cos'] = np.cos(np.radians(values)) * valid
+            volumes['polar_angle_sin'] = np.sin(np.radians(values)) * valid
+        else:
+            volumes[name] = values
+    resampled = dict(zip(volumes, transform_volumes(
+        subject, session, 'func', 'standard',
+        [nib.Nifti1Image(v, ref.affine) for v in volumes.values()])))
+
+    weight = resampled.pop('weight')
+    count = weight >= MIN_WEIGHT
+    sums = {name: np.where(count, values / np.maximum(weight, MIN_WEIGHT), 0)
+            for name, values in resampled.items()}
+    sums['count'] = count.astype(np.float32)
+    return sums
+
+
+def group_maps(fit_dir='mean_before_prf', out_dir='derivatives/pRF/group'):
+
+    """
+    Adds any sessions not yet included to the group sums and writes the
+    group maps to out_dir: {map}_mean.nii.gz for eccentricity, pRF size and
+    r2, polar_angle_circmean.nii.gz and count.nii.gz (sessions contributing
+    to each voxel). If an included session has been refitted since, the
+    sums are rebuilt.
+
+    Args:
+        fit_dir (str): pRF output directory within each session
+        out_dir (str): group output directory
+    """
+
+    sessions = {}
+    for path in sorted(glob.glob(f'derivatives/pRF/sub-*/ses-*/{fit_dir}/'
+                                 f'prfs.mat')):
+        subject, session = path.split('/')[2:4]
+        sessions[f'{subject}/{session}'] = op.getmtime(path)
+    if not sessions:
+        print(f'No pRF fits in {fit_dir} yet, skipping group maps')
+        return
+
+    os.makedirs(out_dir, exist_ok=True)
+    sums_path = f'{out_dir}/sums_{fit_dir}.npz'
+    sums, included = {}, {}
+    if op.isfile(sums_path):
+        stored = dict(np.load(sums_path))
+        included = dict(zip(stored.pop('sessions'), stored.pop('mtimes')))
+        if all(sessions.get(s) == m for s, m in included.items()):
+            sums = stored
+        else:
+            print('Sessions refitted, rebuilding group sums...')
+            included = {}
+
+    todo = [s for s in sessions if s not in included]
+    for sess in todo:
+        print(f'Adding {sess} to group maps...')
+        subject, session = sess.split('/')
+        session_dir = f'derivatives/pRF/{sess}/{fit_dir}'
+        for name, values in session_sums(subject[4:], session,
+                                         session_dir).items():
+            sums[name] = sums.get(name, 0) + values
+        included[sess] = sessions[sess]
+    if not todo and op.isfile(f'{out_dir}/count.nii.gz'):
+        return
+
+    with atomic_write(sums_path) as f:
+        np.savez(f, sessions=np.array(list(included)),
+                 mtimes=np.array(list(included.values())), **sums)
+
+    # group maps
+    ref = nib.load(space_image(None, None, 'standard'))
+    count = sums['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        maps = {f'{name}_mean': sums[name] / count for name in MAPS[1:]}
+    circmean = np.degrees(np.arctan2(sums['polar_angle_sin'],
+                                     sums['polar_angle_cos'])) % 360
+    maps['polar_angle_circmean'] = np.where(count > 0, circmean, np.nan)
+    maps['count'] = count
+    for name, values in maps.items():
+        nib.save(nib.Nifti1Image(values.astype(np.float32), ref.affine),
+                 f'{out_dir}/{name}.nii.gz')
+
+
+if __name__ == "__main__":
+    os.chdir(PROJ_DIR)
+    group_maps()
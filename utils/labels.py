@@ -0,0 +1,118 @@
+# /usr/bin/python
+"""
+In-process FreeSurfer surface labels. A label is handled as a sorted array
+of vertex indices, so unions, intersections and thresholds are set
+operations on integer arrays. Labels are filled into volumes through the
+cached vertex -> voxel indices of surface_sampling, replacing
+mri_cor2label, mri_mergelabels and mri_label2vol round trips.
+"""
+
+import os
+import functools
+import numpy as np
+import nibabel as nib
+
+
+@functools.lru_cache(maxsize=8)
+def _white_coords(subject, hemi):
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    return nib.freesurfer.read_geometry(f'{fs_subj_dir}/surf/{hemi}.white')[0]
+
+
+def read_label(path):
+
+    """
+    Reads a FreeSurfer ascii .label file.
+
+    Returns:
+        vertices (np.ndarray): vertex indices
+        coords (np.ndarray): vertices x 3 surface coordinates
+        values (np.ndarray): value stored with each vertex
+    """
+
+    with open(path) as f:
+        f.readline()  # header
+        num_vertices = int(f.readline())
+        rows = np.array([f.readline().split() for _ in range(num_vertices)],
+                        dtype=float).reshape(num_vertices, 5)
+    return rows[:, 0].astype(int), rows[:, 1:4], rows[:, 4]
+
+
+def write_label(path, vertices, subject, hemi, values=None):
+
+    """
+    Writes vertices as a FreeSurfer ascii .label file, with white surface
+    coordinates, as mri_cor2label does.
+
+    Args:
+        path (str): output .label path
+        vertices (np.ndarray): vertex indices
+        subject (str): subject ID, without the 'sub-' prefix
+        hemi (str): 'lh' or 'rh'
+        values (np.ndarray): value for each vertex, defaults to 0
+    """
+
+    vertices = np.asarray(vertices, dtype=int)
+    coords = _white_coords(subject, hemi)[vertices]
+    values = np.zeros(len(vertices)) if values is None else values
+    with open(path, 'w') as f:
+        f.write(f'#!ascii label  , from subject sub-{subject} '
+                f'vox2ras=TkReg\n{len(vertices)}\n')
+        for v, (x, y, z), value in zip(vertices, coords, values):
+            f.write(f'{v}  {x:.3f}  {y:.3f}  {z:.3f} {value:.10f}\n')
+
+
+def overlay_label(overlay, label_id=None, thresh=None):
+
+    """
+    Vertices of a surface overlay equal to label_id (as mri_cor2label --id)
+    or, if thresh is given, at or above thresh.
+
+    Args:
+        overlay (str or np.ndarray): path to, or values of, an overlay
+    """
+
+    if isinstance(overlay, str):
+        overlay = np.asarray(nib.load(overlay).dataobj)
+    overlay = np.ravel(overlay)
+    if thresh is not None:
+        return np.flatnonzero(np.nan_to_num(overlay, nan=-np.inf) >= thresh)
+    return np.flatnonzero(overlay == label_id)
+
+
+def union(*labels):
+
+    """ Vertices in any of the labels (as mri_mergelabels) """
+
+    return functools.reduce(np.union1d, labels)
+
+
+def intersection(*labels):
+
+    """ Vertices in all of the labels """
+
+    return functools.reduce(np.intersect1d, labels)
+
+
+def label_volume(labels, voxels, shape, dtype=np.uint8):
+
+    """
+    Fills labels into a volume. Every voxel sampled by a label's vertices is
+    set to that label's number (1 for the first label, 2 for the second...),
+    later labels overwriting earlier ones.
+
+    Args:
+        labels (list): vertex index arrays
+        voxels (np.ndarray): vertices x samples voxel indices for the
+            target volume, see surface_sampling.cached_vertex_voxels
+        shape (tuple): shape of the target volume
+
+    Returns:
+        volume (np.ndarray): labelled volume
+    """
+
+    volume = np.zeros(int(np.prod(shape)), dtype=dtype)
+    for l, vertices in enumerate(labels):
+        sampled = voxels[vertices].ravel()
+        volume[sampled[sampled >= 0]] = l + 1
+    return volume.reshape(shape, order='F')
@@ -6,7 +6,12 @@ import glob
 import json
 import shutil
 from .config import PROJ_DIR
-from .get_wang_atlas import get_wang_atlas
+from .get_wang_atlas import get_wang_atlas, neuropythy_atlas
+from .surface_sampling import vol2surf, save_mgh
+from .resample import resample
+from .transforms import transform_file
+from .labels import overlay_label, write_label
+from .qc_montage import submit, ortho_view, wait_for_qc
 
 
 def make_ROIs(subjects=None, overwrite=False):
@@ -15,8 +20,12 @@ def make_ROIs(subjects=None, overwrite=False):
 
     if subjects is None:
         from .config import subjects
-        
+
+    # get retinotopy estimates from public atlas, all subjects in one run
+    neuropythy_atlas([f'sub-{subject}' for subject in subjects])
+
     # get set of posterior cortical voxels to analyse in each subject
+    no_atlas = []
     for subject, sessions in subjects.items():
 
         fs_subj = f'sub-{subject}'
@@ -25,8 +34,10 @@ def make_ROIs(subjects=None, overwrite=False):
 
         ref_anat = f'{fs_subj_dir}/mri/orig/001.nii'
 
-        # get retinotopy estimates from public atlas
-        get_wang_atlas(fs_subj)  # automatically skips if done
+        # split atlas into labels and volumes (the cortex masks below do not
+        # need it, so carry on without it if neuropythy failed)
+        if not get_wang_atlas(fs_subj, run_atlas=False):
+            no_atlas.append(fs_subj)
 
         # make bilateral cortical ribbon nifti in freesurfer directory
         for hemi in ['lh', 'rh']:
@@ -74,7 +85,6 @@ def make_ROIs(subjects=None, overwrite=False):
         for session in sessions:
 
             ref_func = glob.glob(f'{reg_dir}/{session}/example_func.nii*')[0]
-            reg = f'{reg_dir}/{session}/example_func2highres.lta'
             func_dir = f'{mask_dir}/{session}'
             os.makedirs(func_dir, exist_ok=True)
 
@@ -82,12 +92,10 @@ def make_ROIs(subjects=None, overwrite=False):
             cortex_func = f'{func_dir}/cortex.nii.gz'
             if not op.isfile(cortex_func) or overwrite:
                 print('Transforming cortex mask to functional space...')
-                highres2example_func = (
-                    f'{reg_dir}/{session}/highres2example_func.mat')
-                os.system(f'flirt -in {cortex_anat} -ref {ref_func} '
-                          f'-out {cortex_func} -applyxfm '
-                          f'-init {highres2example_func}')
-                os.system(f'fslmaths {cortex_func} -bin {cortex_func}')
+                highres2example_func = transform_file(subject, session,
+                                                      'highres', 'func')
+                resample(cortex_anat, ref_func, highres2example_func,
+                         cortex_func, thresh=0)
 
 
             # make mask of voxels to be analysed by setting y-axis cutoff
@@ -101,17 +109,14 @@ def make_ROIs(subjects=None, overwrite=False):
                 surface = mask.replace('.nii.gz', f'_{hemi}.mgh')
                 if not op.isfile(surface) or overwrite:
                     print('Converting cortex mask to surface label...')
-                    os.system(
-                        f'mri_vol2surf --mov {mask} '
-                        f'--out {surface} --reg {reg} '
-                        f'--hemi {hemi} --interp nearest')
+                    save_mgh(vol2surf(mask, subject, session, hemi), surface)
                 label = surface.replace('.mgh', '.label')
                 if not op.isfile(label):
-                    os.system(f'mri_cor2label --i {surface} '
-                              f'--surf sub-{subject} {hemi} --id 1 --l {label}')
+                    write_label(label, overlay_label(surface, 1), subject,
+                                hemi)
 
 
-            # ROI plots
+            # ROI plots (rendered in the background, see qc_montage)
             plot_dir = f'derivatives/ROIs/plots'
             os.makedirs(plot_dir, exist_ok=True)
             for space, ref, mask_path in zip(
@@ -121,17 +126,7 @@ def make_ROIs(subjects=None, overwrite=False):
                 plot_file = (f'{plot_dir}/sub-{subject}_'
                              f'{session}_{space}_cortex.png')
                 if not op.isfile(plot_file) or overwrite:
-                    ref_range = os.popen(f'fslstats {ref} -R')
-                    ref_max = float(ref_range.read().split()[1])
-                    coords = (os.popen(f'fslstats {mask_path} -C')
-                        .read()[:-2].split(' '))
-                    coords = [int(float(c)) for c in coords]
-                    cmd = f'fsleyes render --outfile {plot_file} --size 3200 ' \
-                          f'600 --scene ortho --autoDisplay -vl {coords[0]} ' \
-                          f'{coords[1]} {coords[2]} ' \
-                          f'{ref} -dr 0 {ref_max} {mask_path} -dr 0 1 -cm ' \
-                          f'greyscale'
-                    os.system(cmd)
+                    submit(ortho_view, ref, mask_path, plot_file)
 
             # make links to reference anat image
             local_anat = f'{mask_dir}/anat_space/ref_anat.nii'
@@ -153,6 +148,10 @@ def make_ROIs(subjects=None, overwrite=False):
                 if not op.isfile(mask_path):  # or overwrite:
                     os.system(f'mri_synthstrip -i {ref_func} -m {mask_path}')# -g')
 
+    if no_atlas:
+        print(f'Warning: no Wang atlas ROIs for {", ".join(no_atlas)}; rerun '
+              f'make_ROIs once neuropythy succeeds for them')
+
 
 if __name__ == "__main__":
 
@@ -162,3 +161,4 @@ if __name__ == "__main__":
     subjects = json.load(open("participants.json", "r+"))
     for subject in subjects:
         make_ROIs(overwrite, subject)
+    wait_for_qc()
@@ -1,30 +1,39 @@
 import nibabel as nib
+import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.image import imsave
 from tqdm import tqdm
 
-def make_anat_slices(subject, T1, outdir=None, slice_interval=4):
+def make_anat_slices(subject, T1, outdir=None, slice_interval=4,
+                     num_threads=8):
+
+    """
+    Writes every slice_interval'th sagittal, coronal and axial slice of T1 as
+    {outdir}/X_{x}.png, Y_{y}.png and Z_{z}.png. The image is loaded once
+    and the PNGs are encoded in parallel threads.
+    """
 
     print(f'creating anatomical images for subject {subject}')
     if outdir is None:
         outdir = f'/home/tonglab/david/subjects/for_subjects/{subject}/2D'
     os.makedirs(outdir, exist_ok=True)
 
-    # get dimensions of image
-    T1info = os.popen(f"fslinfo {T1}").readlines()[1:4]
-    T1Shape = [int(x.split('\t')[2]) for x in T1info]
-
-    print(f'getting sagittal slices\n')
-    for x in tqdm(range(T1Shape[0])):
-        if x % slice_interval == 0:
-            os.system(f'slicer {T1} -x -{x} {outdir}/X_{x}.png')
+    # load image once, display range as slicer's robust range
+    data = np.asarray(nib.load(T1).dataobj, dtype=np.float32)
+    data = data.reshape(data.shape[:3])
+    vmin, vmax = np.percentile(data[data > 0], [2, 98]) if data.any() \
+        else (0, 1)
 
-    print(f'\ngetting coronal slices\n')
-    for y in tqdm(range(T1Shape[1])):
-        if y % slice_interval == 0:
-            os.system(f'slicer {T1} -y -{y} {outdir}/Y_{y}.png')
+    jobs = [(axis, index) for axis in range(3)
+            for index in range(0, data.shape[axis], slice_interval)]
 
-    print(f'\ngetting axial slices\n')
-    for z in tqdm(range(T1Shape[2])):
-        if z % slice_interval == 0:
-            os.system(f'slicer {T1} -z -{z} {outdir}/Z_{z}.png')
+    def save_slice(job):
+        axis, index = job
+        image = np.take(data, index, axis=axis).T  # superior/anterior up
+        imsave(f'{outdir}/{"XYZ"[axis]}_{index}.png', image, cmap='gray',
+               vmin=vmin, vmax=vmax, origin='lower')
 
+    print(f'saving {len(jobs)} sagittal, coronal and axial slices\n')
+    with ThreadPoolExecutor(num_threads) as executor:
+        list(tqdm(executor.map(save_slice, jobs), total=len(jobs)))
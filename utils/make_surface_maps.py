@@ -4,6 +4,9 @@ import glob
 import nibabel as nib
 import numpy as np
 import shutil
+from .surface_sampling import vol2surf, save_mgh
+from .labels import overlay_label, write_label
+from .surface_smoothing import smooth_surface_maps
 
 
 def make_surface_maps(overwrite=False):
@@ -16,40 +19,23 @@ def make_surface_maps(overwrite=False):
         # get subject and session
         subject = prf_dir.split('/')[2].split('-')[1]
         session = prf_dir.split('/')[3]
-        reg = (f'derivatives/registration/sub-{subject}/'
-               f'{session}/example_func2highres.lta')
         roi_dir = f'derivatives/ROIs/sub-{subject}/{session}'
-        roi = f'{roi_dir}/mask_analyzed.nii.gz'
 
-        # for left hemisphere, any smoothing in the polar angle map will
-        # cause issues where the map wraps around the 0/360 degree boundary.
-        # Flip the map so the boundary moves to the left horizontal meridian
-        ang_reverse = f'{prf_dir}/polar_angle_flip.nii.gz'
-        if not os.path.isfile(ang_reverse) or overwrite:
-            os.system(f'fslmaths {prf_dir}/polar_angle.nii '
-                      f'-mul -1 -add 540 -rem 360 -mul {roi} {ang_reverse}')
-
-        # copy hdr from example func so they align
-        for parameter in parameters + ['polar_angle_flip']:
-            example_func = glob.glob(f'derivatives/registration/sub-{subject}/'
-                            f'{session}/example_func.nii*')[0]
-            nii = glob.glob(f'{prf_dir}/{parameter}.nii*')[0]
-            os.system(f'fslcpgeom {example_func} {nii}')
-
-        # convert to surface
+        # convert to surface by sampling the nearest voxel to each vertex,
+        # using vertex -> voxel indices cached per session and hemisphere.
+        # Maps are read as arrays on the example func grid, so their headers
+        # need not match it.
         for parameter in parameters:
             for hemi in ['lh','rh']:
-
-                if parameter == 'polar_angle' and hemi == 'lh':
-                    nifti = f'{prf_dir}/polar_angle_flip.nii.gz'
-                else:
-                    nifti = f'{prf_dir}/{parameter}.nii'
-
                 surface = f'{prf_dir}/{parameter}_{hemi}.mgh'
                 if not op.isfile(surface) or overwrite:
-                    os.system(
-                        f'mri_vol2surf --mov {nifti} --out {surface} '
-                        f'--reg {reg} --hemi {hemi} --interp nearest')
+                    volume = nib.load(f'{prf_dir}/{parameter}.nii').get_fdata()
+                    save_mgh(vol2surf(volume, subject, session, hemi),
+                             surface)
+
+        # smoothed copies for labelling (polar angle as unit vectors, so
+        # the 0/360 boundary is handled)
+        smooth_surface_maps(subject, prf_dir, parameters, overwrite)
 
         # make label to mask out unanalyzed or low r2 voxels
         thresh = 10
@@ -63,14 +49,11 @@ def make_surface_maps(overwrite=False):
             surface = roi_r2_thresh.replace('.nii.gz', f'_{hemi}.mgh')
             if not op.isfile(surface) or overwrite:
                 print('Converting cortex mask to surface label...')
-                os.system(
-                    f'mri_vol2surf --mov {roi_r2_thresh} '
-                    f'--out {surface} --reg {reg} '
-                    f'--hemi {hemi} --interp nearest')
+                save_mgh(vol2surf(roi_r2_thresh, subject, session, hemi),
+                         surface)
             label = surface.replace('.mgh', '.label')
             if not op.isfile(label) or overwrite:
-                os.system(f'mri_cor2label --i {surface} '
-                          f'--surf sub-{subject} {hemi} --id 1 --l {label}')
+                write_label(label, overlay_label(surface, 1), subject, hemi)
 
 if __name__ == "__main__":
     make_surface_maps()
\ No newline at end of file
@@ -0,0 +1,102 @@
+# /usr/bin/python
+"""
+Bounded-memory reading of 4D functional timeseries restricted to a mask.
+The (possibly gzipped) NIfTI is decompressed in a single sequential pass,
+a few volumes at a time, keeping only the voxels inside the mask. Results
+fitted on the packed voxels x time matrix are scattered back into volumes
+using the returned voxel indices.
+"""
+
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+
+
+def mask_indices(mask):
+
+    """
+    Flat indices of the nonzero voxels of a 3D mask, in the order voxels are
+    stored on disk (x fastest), along with the mask image.
+    """
+
+    img = nib.load(mask)
+    indices = np.flatnonzero(np.asarray(img.dataobj).ravel(order='F') > 0)
+    return indices, img
+
+
+def iter_masked_chunks(func, indices, chunk_vols=16):
+
+    """
+    Streams masked data from a 4D NIfTI.
+
+    Args:
+        func (str): path to 4D NIfTI (.nii or .nii.gz)
+        indices (np.ndarray): flat voxel indices, see mask_indices
+        chunk_vols (int): number of volumes decompressed at a time
+
+    Yields:
+        t0 (int): index of the first volume in the chunk
+        chunk (np.ndarray): n_mask_voxels x chunk_vols float32 matrix
+    """
+
+    proxy = nib.load(func).dataobj  # on-disk layout, no data read
+    vol_size, num_vols = int(np.prod(proxy.shape[:3])), proxy.shape[3]
+    dtype = proxy.dtype
+    with ImageOpener(func) as f:
+        f.seek(proxy.offset)
+        for t0 in range(0, num_vols, chunk_vols):
+            n = min(chunk_vols, num_vols - t0)
+            vols = np.frombuffer(f.read(n * vol_size * dtype.itemsize),
+                                 dtype).reshape(n, vol_size)
+            chunk = vols[:, indices].T.astype(np.float32)
+            chunk *= proxy.slope
+            chunk += proxy.inter
+            yield t0, chunk
+
+
+def load_masked_timeseries(funcs, mask, chunk_vols=16):
+
+    """
+    Reads the voxels inside mask into a packed matrix, concatenating runs in
+    time if several funcs are given. Peak memory is the masked data plus
+    chunk_vols full volumes.
+
+    Returns:
+        data (np.ndarray): n_mask_voxels x time float32 matrix
+        indices (np.ndarray): flat voxel indices, see unmask
+        ref (nib.Nifti1Image): the mask image, for writing results
+    """
+
+    funcs = [funcs] if isinstance(funcs, str) else funcs
+    indices, ref = mask_indices(mask)
+    for func in funcs:
+        assert nib.load(func).shape[:3] == ref.shape[:3], \
+            f'{mask} does not match {func}'
+    return load_indexed_timeseries(funcs, indices, chunk_vols), indices, ref
+
+
+def load_indexed_timeseries(funcs, indices, chunk_vols=16):
+
+    """
+    Reads the voxels at the given flat indices into a packed n_indices x
+    time float32 matrix, concatenating runs in time.
+    """
+
+    funcs = [funcs] if isinstance(funcs, str) else funcs
+    num_vols = [nib.load(func).shape[3] for func in funcs]
+    data = np.empty((len(indices), sum(num_vols)), dtype=np.float32)
+    start = 0
+    for func, n in zip(funcs, num_vols):
+        for t0, chunk in iter_masked_chunks(func, indices, chunk_vols):
+            data[:, start + t0:start + t0 + chunk.shape[1]] = chunk
+        start += n
+    return data
+
+
+def unmask(values, indices, shape, fill=np.nan):
+
+    """ Scatters per-voxel values back into a volume of the given shape """
+
+    volume = np.full(int(np.prod(shape)), fill, dtype=np.float32)
+    volume[indices] = values
+    return volume.reshape(shape, order='F')
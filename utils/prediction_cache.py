@@ -0,0 +1,88 @@
+# /usr/bin/python
+"""
+Persistent, content-addressed cache of pRF aperture overlap matrices. The
+overlap of each candidate Gaussian pRF with the stimulus aperture at each
+time point depends only on the stimulus and the grid, so it is shared by
+every subject viewing the same stimulus and by every model (HRF, CSS
+exponent) built on top of it. Matrices are stored as float32 .npy files that
+are memory-mapped on load. The cache is bounded in size, evicting the least
+recently used entries first.
+"""
+
+import os
+import os.path as op
+import glob
+import hashlib
+import json
+import numpy as np
+from .config import prf_params
+from .atomic import atomic_write
+
+
+def _digest(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+def cache_key(stim, dynamics, apertures, grid, params=prf_params):
+
+    """
+    Hash identifying an overlap matrix. The aperture and grid arrays are
+    hashed by content, so a changed stimulus file or grid specification
+    never returns stale overlaps.
+    """
+
+    spec = {'stim': stim, 'dynamics': int(dynamics),
+            'stim_radius_deg': params['stim_radius_deg'],
+            'apertures': _digest(apertures), 'grid': _digest(grid)}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def evict(cache_dir, max_bytes, keep=None):
+
+    """
+    Deletes least recently used entries until the cache fits max_bytes,
+    never deleting keep (the entry about to be used)
+    """
+
+    entries = sorted(glob.glob(f'{cache_dir}/*.npy'), key=op.getmtime)
+    total = sum(op.getsize(f) for f in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if keep is not None and op.abspath(entry) == op.abspath(keep):
+            continue
+        total -= op.getsize(entry)
+        os.remove(entry)
+
+
+def cached_overlaps(stim, apertures, grid, make, params=prf_params):
+
+    """
+    Returns the overlap matrix for these settings from the cache, building
+    it with make() and storing it on a miss.
+
+    Args:
+        stim (str): name of stimulus
+        apertures (np.ndarray): time x res x res stimulus apertures
+        grid (np.ndarray): candidate pRF centres and sizes
+        make (callable): builds the time x n_candidates matrix on a miss
+        params (dict): model parameters, see config.prf_params
+
+    Returns:
+        overlaps (np.ndarray): read-only memory-mapped float32 matrix
+    """
+
+    cache_dir = params['cache_dir']
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(stim, len(apertures), apertures, grid, params)
+    path = f'{cache_dir}/{key}.npy'
+    hit = op.isfile(path)
+    if hit:
+        os.utime(path)  # mark as recently used
+    else:
+        with atomic_write(path) as f:
+            np.save(f, make().astype(np.float32))
+    overlaps = np.load(path, mmap_mode='r')
+    if not hit:
+        evict(cache_dir, params['cache_max_gb'] * 1e9, keep=path)
+    return overlaps
@@ -0,0 +1,57 @@
+# /usr/bin/python
+"""
+Overlaps reading of upcoming inputs with processing of the current one. A
+background thread loads items ahead of the consumer into a bounded queue,
+so I/O and decompression (which release the GIL) run while the main thread
+is busy fitting.
+"""
+
+import queue
+import threading
+
+_DONE = object()
+
+
+def prefetch(load, items, depth=1):
+
+    """
+    Yields (item, load(item)) for each item in order, loading up to depth
+    items ahead on a background thread. At most depth loaded items wait in
+    the queue, plus one being loaded, which bounds memory use. Exceptions
+    raised by load are re-raised in the consumer when that item is reached.
+
+    Args:
+        load (callable): reads the data for one item
+        items (iterable): items to load
+        depth (int): maximum number of loaded items waiting to be consumed
+    """
+
+    loaded = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def producer():
+        for item in items:
+            if stop.is_set():
+                return
+            try:
+                loaded.put((item, load(item), None))
+            except Exception as error:
+                loaded.put((item, None, error))
+                return
+        loaded.put(_DONE)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while (entry := loaded.get()) is not _DONE:
+            item, data, error = entry
+            if error is not None:
+                raise error
+            yield item, data
+    finally:
+        stop.set()  # consumer stopped early, let the producer finish
+        while thread.is_alive():
+            try:
+                loaded.get(timeout=.1)
+            except queue.Empty:
+                pass
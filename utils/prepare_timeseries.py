@@ -0,0 +1,145 @@
+# /usr/bin/python
+"""
+In-process preparation of retinotopy timeseries. After motion correction to
+the reference functional volume, each run is high-pass filtered with an
+FSL-compatible filter (fslmaths -bptf), its temporal mean restored, NaNs
+zeroed and the runs averaged, all in memory. Previously every step was a
+separate fslmaths call that re-read and re-compressed the 4D file.
+"""
+
+import os
+import os.path as op
+import numpy as np
+import nibabel as nib
+
+SLAB_VOXELS = 2 ** 16  # voxels filtered at a time (x time points)
+
+
+def highpass_matrix(num_vols, hp_sigma):
+
+    """
+    Linear operator equivalent to fslmaths -bptf hp_sigma -1. At each time
+    point FSL fits a line to the surrounding data, weighted by a Gaussian
+    (sigma in volumes, truncated at 3 sigma), and subtracts the fitted value.
+    Row t of the returned matrix holds the weights of that fitted value, so
+    filtered = data - H @ data for a time x voxels matrix.
+    """
+
+    half_width = int(hp_sigma * 3)
+    H = np.zeros((num_vols, num_vols))
+    for t in range(num_vols):
+        window = np.arange(max(t - half_width, 0),
+                           min(t + half_width, num_vols - 1) + 1)
+        dt = window - t
+        w = np.exp(-.5 * dt ** 2 / hp_sigma ** 2)
+        A, C, N = (w * dt).sum(), (w * dt ** 2).sum(), w.sum()
+        denom = C * N - A ** 2
+        if denom != 0:
+            H[t, window] = w * (C - A * dt) / denom
+    return H.astype(np.float32)
+
+
+def filter_run(func, H, slab_voxels=SLAB_VOXELS):
+
+    """
+    Returns the high-pass filtered run with its temporal mean added back
+    and NaNs set to zero (fslmaths -bptf ... -add tmean -nan), plus the
+    temporal mean volume. The run is read and filtered in float32 slabs of
+    z planes holding at most slab_voxels voxels, written into the output
+    slab by slab, so only one full copy of the run is held.
+    """
+
+    img = nib.load(func)
+    shape = img.shape
+    data = np.empty(shape, dtype=np.float32)
+    tmean = np.empty(shape[:3], dtype=np.float32)
+    planes = max(1, slab_voxels // (shape[0] * shape[1]))
+    for start in range(0, shape[2], planes):
+        stop = min(start + planes, shape[2])
+        slab = np.array(img.dataobj[:, :, start:stop], dtype=np.float32,
+                        order='C')
+        series = slab.reshape(-1, shape[3]).T  # time x voxels view
+        mean = series.mean(axis=0)
+        series -= H @ series
+        series += mean
+        slab[np.isnan(slab)] = 0
+        mean[np.isnan(mean)] = 0
+        data[:, :, start:stop] = slab
+        tmean[:, :, start:stop] = mean.reshape(slab.shape[:3])
+    return data, tmean
+
+
+def save_like(data, ref, path):
+
+    """ Saves float32 data with the geometry of ref """
+
+    header = ref.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(data, ref.affine, header), path)
+
+
+def prepare_session(funcs, ref_func, sess_dir, hp_sigma=60, keep_runs=False,
+                    concatenate=False):
+
+    """
+    Motion corrects each run to ref_func with mcflirt, then filters and
+    averages the runs in memory, writing the session mean timeseries to
+    {sess_dir}/mean_before_prf/timeseries.nii.gz.
+
+    Args:
+        funcs (list): paths to the raw runs
+        ref_func (str): reference functional volume
+        sess_dir (str): pRF directory for this session
+        hp_sigma (float): high-pass filter sigma (volumes), as for -bptf
+        keep_runs (bool): also write each filtered run to
+            {sess_dir}/timeseries_run-*.nii.gz (e.g. for cross-validation)
+        concatenate (bool): also write the runs concatenated in time, each
+            with its own temporal mean replaced by the mean across runs, to
+            {sess_dir}/concatenated_before_prf/timeseries.nii.gz
+    """
+
+    # motion correction, uncompressed so it can be read back quickly
+    mcfs = []
+    for func in funcs:
+        run = func.split('_')[-3]
+        mcf = f'{sess_dir}/mcf_{run}.nii'
+        if not op.isfile(mcf):
+            os.system(f'FSLOUTPUTTYPE=NIFTI mcflirt -in {func} '
+                      f'-reffile {ref_func} -out {mcf[:-4]}')
+        mcfs.append(mcf)
+
+    ref = nib.load(mcfs[0])
+    H = highpass_matrix(ref.shape[3], hp_sigma)
+    mean = np.zeros(ref.shape, dtype=np.float32)
+    tmeans = []
+    for func, mcf in zip(funcs, mcfs):
+        data, tmean = filter_run(mcf, H)
+        mean += data
+        tmeans.append(tmean)
+        if keep_runs:
+            run = func.split('_')[-3]
+            save_like(data, ref, f'{sess_dir}/timeseries_{run}.nii.gz')
+        del data
+    mean /= len(mcfs)
+    out_dir = f'{sess_dir}/mean_before_prf'
+    os.makedirs(out_dir, exist_ok=True)
+    save_like(mean, ref, f'{out_dir}/timeseries.nii.gz')
+    del mean
+
+    # demean each run then add the mean across runs, before concatenating
+    if concatenate:
+        tmean_all = np.mean(tmeans, axis=0)
+        num_vols = ref.shape[3]
+        concatenated = np.empty((*ref.shape[:3], num_vols * len(mcfs)),
+                                dtype=np.float32)
+        for r, (mcf, tmean) in enumerate(zip(mcfs, tmeans)):
+            run = concatenated[..., r * num_vols:(r + 1) * num_vols]
+            run[:] = filter_run(mcf, H)[0]
+            run -= tmean[..., None]
+            run += tmean_all[..., None]
+        out_dir = f'{sess_dir}/concatenated_before_prf'
+        os.makedirs(out_dir, exist_ok=True)
+        save_like(concatenated, ref, f'{out_dir}/timeseries.nii.gz')
+
+    for mcf in mcfs:
+        os.remove(mcf)
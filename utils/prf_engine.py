@@ -0,0 +1,878 @@
+# /usr/bin/python
+"""
+Native Gaussian population receptive field (pRF) engine. Replaces the
+MATLAB analyzePRF call with a NumPy/SciPy implementation of the same model:
+an isotropic 2D Gaussian in the visual field, multiplied by the stimulus
+aperture, summed over space and convolved with a canonical HRF. The
+compressive spatial summation (CSS) model additionally raises the summed
+overlap to a power n <= 1 before convolution. Fitting is a batched grid
+search (matrix products of voxels x candidate predictions) followed by a
+vectorised pattern search refinement of each voxel's estimate.
+"""
+
+import os
+import os.path as op
+import glob
+import hashlib
+import itertools
+import json
+import tempfile
+from collections import namedtuple
+from multiprocessing import get_context
+import numpy as np
+import nibabel as nib
+import scipy.io
+from scipy.ndimage import zoom
+from scipy.signal import fftconvolve
+from scipy.stats import gamma
+from .config import prf_params
+from .prediction_cache import cached_overlaps, _digest
+from .masked_timeseries import unmask
+from .surface_sampling import save_mgh
+from .atomic import atomic_write
+
+# predictions with a smaller norm barely overlap the stimulus and cannot be
+# normalised reliably in float32
+MIN_NORM = 1e-4
+
+# voxels x candidates projections held at once in a grid search (float32)
+SEARCH_BLOCK = 2 ** 24
+
+
+def resample_apertures(apertures, res):
+
+    """ Resamples a time x height x width aperture array to res x res """
+
+    if apertures.shape[1:] == (res, res):
+        return apertures.astype(np.float32)
+    apertures = zoom(apertures, (1, res / apertures.shape[1],
+                                 res / apertures.shape[2]), order=1)
+    return np.clip(apertures, 0, 1).astype(np.float32)
+
+
+def load_stimulus(stim, res=None):
+
+    """
+    Loads stimulus apertures for a retinotopy stimulus (e.g. 'wedge_ring',
+    'multibar'), sampled at one frame per TR. Apertures are stored either as
+    {stim_dir}/{stim}.mat (variable 'stimulus', res x res x time, as used by
+    analyzePRF) or {stim_dir}/{stim}.npy (time x res x res).
+
+    Args:
+        stim (str): name of stimulus
+        res (int): if set, apertures are resampled to res x res pixels
+
+    Returns:
+        apertures (np.ndarray): time x res x res array with values in [0, 1]
+    """
+
+    path = sorted(glob.glob(f'{prf_params["stim_dir"]}/{stim}.*'))[0]
+    if path.endswith('.mat'):
+        apertures = np.moveaxis(scipy.io.loadmat(path)['stimulus'], -1, 0)
+    else:
+        apertures = np.load(path)
+    apertures = apertures.astype(np.float32)
+    apertures /= apertures.max()
+    if res is not None and res != apertures.shape[1]:
+        apertures = resample_apertures(apertures, res)
+    return apertures
+
+
+def visual_field(res, radius):
+
+    """
+    Visual field coordinates (deg) of each aperture pixel centre, flattened
+    in the same order as the aperture images. y increases upwards.
+    """
+
+    coords = ((np.arange(res) + .5) / res * 2 - 1) * radius
+    X, Y = np.meshgrid(coords, -coords)
+    return X.ravel().astype(np.float32), Y.ravel().astype(np.float32)
+
+
+def grid_axes(params=prf_params):
+
+    """
+    Lattice of pRF centres (deg, same for x and y), sizes (deg) and CSS
+    exponents (a single exponent of 1 for the Gaussian model)
+    """
+
+    extent = params['stim_radius_deg'] * params['grid_extent']
+    xy = np.linspace(-extent, extent, params['grid_xy'])
+    sigma_min, sigma_max, num_sigmas = params['grid_sigma']
+    sigmas = np.geomspace(sigma_min, sigma_max, num_sigmas)
+    exponents = np.ones(1)
+    if params['model'] == 'css':
+        exponents = np.geomspace(*params['css_exponent'])
+    return xy, sigmas, exponents
+
+
+def coarse_params(params=prf_params):
+
+    """ Model parameters for the coarse stage of coarse-to-fine search """
+
+    return dict(params, aperture_res=params['coarse_res'],
+                grid_xy=params['coarse_grid_xy'],
+                grid_sigma=(*params['grid_sigma'][:2],
+                            params['coarse_grid_sigma']))
+
+
+def make_grid(params=prf_params):
+
+    """
+    Candidate pRFs for the grid search as an (n_candidates, 4) array of
+    x (deg), y (deg), sigma (deg) and exponent n. Centres lie on a square
+    lattice restricted to a disc, sizes and exponents are log-spaced. The
+    exponent varies fastest, so each centre and size occupies a contiguous
+    block of len(exponents) rows.
+    """
+
+    extent = params['stim_radius_deg'] * params['grid_extent']
+    xy, sigmas, exponents = grid_axes(params)
+    x, y, s, n = np.meshgrid(xy, xy, sigmas, exponents, indexing='ij')
+    keep = np.hypot(x, y) <= extent
+    return np.column_stack([x[keep], y[keep], s[keep], n[keep]]).astype(
+        np.float32)
+
+
+def spm_hrf(TR, duration=32):
+
+    """ Canonical double-gamma HRF sampled at TR, normalised to unit sum """
+
+    t = np.arange(0, duration, TR)
+    hrf = gamma.pdf(t, 6) - gamma.pdf(t, 16) / 6
+    return (hrf / hrf.sum()).astype(np.float32)
+
+
+def gaussian_rfs(X, Y, x, y, sigma, pixel_area):
+
+    """
+    Gaussian pRFs evaluated at each aperture pixel, returned as a
+    (pixels, pRFs) matrix. Each pRF is scaled to unit volume so the
+    response reflects the proportion of the pRF covered by the stimulus.
+    """
+
+    dist_sq = (X[:, None] - x) ** 2 + (Y[:, None] - y) ** 2
+    rfs = np.exp(-dist_sq / (2 * sigma ** 2))
+    rfs *= pixel_area / (2 * np.pi * sigma ** 2)
+    return rfs.astype(np.float32)
+
+
+def convolve_hrf(timecourses, hrf):
+
+    """ Causal convolution of each column of a time x n matrix with the HRF """
+
+    T = timecourses.shape[0]
+    return fftconvolve(timecourses, hrf[:, None], axes=0)[:T].astype(
+        np.float32)
+
+
+def drift_basis(T_run, n_runs, degree):
+
+    """
+    Orthonormal basis of Legendre polynomials (up to degree) for each run,
+    used to project slow drifts out of data and predictions.
+    """
+
+    t = np.linspace(-1, 1, T_run)
+    polys = np.polynomial.legendre.legvander(t, degree)
+    basis, _ = np.linalg.qr(np.kron(np.eye(n_runs), polys))
+    return basis.astype(np.float32)
+
+
+def residualise(timecourses, basis):
+
+    """ Removes the span of basis from each column of a time x n matrix """
+
+    return timecourses - basis @ (basis.T @ timecourses)
+
+
+def make_overlaps(apertures, grid, params=prf_params, chunk=2048):
+
+    """
+    Proportion of each candidate Gaussian (x, y, sigma columns of grid)
+    covered by the stimulus at each time point, computed in chunks of
+    candidates as aperture x Gaussian matrix products.
+
+    Returns:
+        overlaps (np.ndarray): time x n_candidates float32 matrix
+    """
+
+    T, res = apertures.shape[:2]
+    X, Y = visual_field(res, params['stim_radius_deg'])
+    pixel_area = (2 * params['stim_radius_deg'] / res) ** 2
+    A = apertures.reshape(T, -1)
+    overlaps = np.empty((T, len(grid)), dtype=np.float32)
+    for c in range(0, len(grid), chunk):
+        x, y, sigma = grid[c:c + chunk, :3].T
+        overlaps[:, c:c + chunk] = A @ gaussian_rfs(X, Y, x, y, sigma,
+                                                    pixel_area)
+    return overlaps
+
+
+def make_predictions(overlaps, exponents, hrf, chunk=2048):
+
+    """
+    Predicted timecourses for every combination of overlap column and
+    exponent, evaluating all exponents for a chunk of overlaps at once
+    before HRF convolution. Exponent varies fastest, as in make_grid.
+
+    Returns:
+        predictions (np.ndarray): time x (n_overlaps * n_exponents) matrix
+    """
+
+    T, num_overlaps = overlaps.shape
+    num_exp = len(exponents)
+    exponents = exponents.astype(np.float32)
+    predictions = np.empty((T, num_overlaps * num_exp), dtype=np.float32)
+    for c in range(0, num_overlaps, chunk):
+        block = np.asarray(overlaps[:, c:c + chunk])
+        if num_exp > 1 or exponents[0] != 1:
+            block = (block[:, :, None] ** exponents).reshape(T, -1)
+        predictions[:, c * num_exp:(c + chunk) * num_exp] = convolve_hrf(
+            block, hrf)
+    return predictions
+
+
+def predict_timecourses(x, y, sigma, apertures, TR, params=prf_params,
+                        n=None, chunk=2048):
+
+    """
+    Predicted timecourses (time x voxels, unit gain, no drift) of fitted
+    pRFs, e.g. for scoring held-out data. n holds CSS exponents, if any.
+    """
+
+    T = apertures.shape[0]
+    apertures = resample_apertures(apertures, params['aperture_res'])
+    X, Y = visual_field(params['aperture_res'], params['stim_radius_deg'])
+    pixel_area = (2 * params['stim_radius_deg'] / params['aperture_res']) ** 2
+    hrf = spm_hrf(TR)
+    predictions = np.empty((T, len(x)), dtype=np.float32)
+    for c in range(0, len(x), chunk):
+        rfs = gaussian_rfs(X, Y, x[c:c + chunk], y[c:c + chunk],
+                           sigma[c:c + chunk], pixel_area)
+        overlaps = apertures.reshape(T, -1) @ rfs
+        if n is not None:
+            overlaps **= n[c:c + chunk]
+        predictions[:, c:c + chunk] = convolve_hrf(overlaps, hrf)
+    return predictions
+
+
+# a shared array saved to disk for workers to memory-map, so that it is
+# held once in the page cache rather than pickled into every worker
+Mapped = namedtuple('Mapped', ['path'])
+MAP_BYTES = 2 ** 20  # shared arrays at least this large are memory-mapped
+
+
+def _map_arrays(shared, tmp_dir):
+
+    """ shared, with large arrays replaced by Mapped .npy files in tmp_dir """
+
+    mapped = dict(shared)
+    for name, value in shared.items():
+        if isinstance(value, np.ndarray) and value.nbytes >= MAP_BYTES:
+            path = f'{tmp_dir}/{name}.npy'
+            np.save(path, value)
+            mapped[name] = Mapped(path)
+    return mapped
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = {name: np.load(value.path, mmap_mode='r')
+               if isinstance(value, Mapped) else value
+               for name, value in shared.items()}
+
+
+def _predict(x, y, sigma, n):
+
+    """ Residualised predictions (time x voxels) for per-voxel parameters """
+
+    s = _shared
+    T_run = s['apertures'].shape[0]
+    rfs = gaussian_rfs(s['X'], s['Y'], x, y, sigma, s['pixel_area'])
+    overlaps = s['apertures'].reshape(T_run, -1) @ rfs
+    if s['params']['model'] == 'css':
+        overlaps **= n
+    predictions = convolve_hrf(overlaps, s['hrf'])
+    predictions = np.tile(predictions, (s['n_runs'], 1))
+    return residualise(predictions, s['drift'])
+
+
+def _score(data, x, y, sigma, n):
+
+    """
+    Projection of each voxel's data onto its unit-norm prediction, i.e.
+    correlation x data norm, and the prediction norm (needed for the gain).
+    """
+
+    predictions = _predict(x, y, sigma, n)
+    norms = np.linalg.norm(predictions, axis=0)
+    scores = np.einsum('vt,tv->v', data, predictions)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(norms > MIN_NORM, scores / norms, -np.inf)
+    return scores, norms
+
+
+def refine(data, x, y, sigma, n, scores, params=prf_params):
+
+    """
+    Vectorised pattern search starting from the grid search estimates. On
+    each iteration, every voxel tries a step in both directions along x, y,
+    log(sigma) and, for the CSS model, log(n), keeps any improvement, and
+    halves its step size if none was found.
+    """
+
+    extent = params['stim_radius_deg'] * params['grid_extent']
+    sigma_min, sigma_max, num_sigmas = params['grid_sigma']
+    log_bounds = np.log([sigma_min / 2, sigma_max * 2])
+    current = np.column_stack([x, y, np.log(sigma), np.log(n)]).astype(
+        np.float32)
+    step = np.empty_like(current)
+    step[:, :2] = extent / (params['grid_xy'] - 1)
+    step[:, 2] = np.log(sigma_max / sigma_min) / (num_sigmas - 1) / 2
+    num_dims = 3
+    if params['model'] == 'css':
+        n_min, n_max, num_exp = params['css_exponent']
+        step[:, 3] = np.log(n_max / n_min) / max(num_exp - 1, 1) / 2
+        n_bounds = np.log([n_min / 2, 1])  # compressive only
+        num_dims = 4
+    norms = _score(data, x, y, sigma, n)[1]
+    for _ in range(params['refine_iters']):
+        improved = np.zeros(len(data), dtype=bool)
+        for dim, sign in itertools.product(range(num_dims), (-1, 1)):
+            candidate = current.copy()
+            candidate[:, dim] += sign * step[:, dim]
+            ecc = np.hypot(candidate[:, 0], candidate[:, 1])
+            candidate[:, :2] *= np.minimum(1, extent / np.maximum(ecc, 1e-6))[
+                :, None]
+            candidate[:, 2] = np.clip(candidate[:, 2], *log_bounds)
+            if num_dims == 4:
+                candidate[:, 3] = np.clip(candidate[:, 3], *n_bounds)
+            new_scores, new_norms = _score(
+                data, candidate[:, 0], candidate[:, 1],
+                np.exp(candidate[:, 2]), np.exp(candidate[:, 3]))
+            better = new_scores > scores
+            current[better] = candidate[better]
+            scores[better] = new_scores[better]
+            norms[better] = new_norms[better]
+            improved |= better
+        step[~improved] /= 2
+    return (current[:, 0], current[:, 1], np.exp(current[:, 2]),
+            np.exp(current[:, 3]), scores, norms)
+
+
+def _lattice_indices(x, y, sigma, params):
+
+    """ Nearest fine lattice point (ix, iy, isigma) to each set of parameters """
+
+    xy, sigmas = grid_axes(params)[:2]
+    return np.column_stack([
+        np.rint((x - xy[0]) / (xy[1] - xy[0])),
+        np.rint((y - xy[0]) / (xy[1] - xy[0])),
+        np.rint(np.log(sigma / sigmas[0]) / np.log(sigmas[1] / sigmas[0]))
+    ]).astype(int)
+
+
+def lattice_lookup(grid, params=prf_params):
+
+    """
+    Lattice point (ix, iy, isigma, iexponent) -> column of the fine grid, -1
+    if not a candidate
+    """
+
+    xy, sigmas, exponents = grid_axes(params)
+    lookup = np.full((len(xy), len(xy), len(sigmas), len(exponents)), -1)
+    ix, iy, isigma = _lattice_indices(*grid[:, :3].T, params).T
+    iexp = np.abs(grid[:, 3, None] - exponents).argmin(axis=1)
+    lookup[ix, iy, isigma, iexp] = np.arange(len(grid))
+    return lookup
+
+
+def neighbourhoods(centres, lookup, r_xy, r_sigma, params=prf_params):
+
+    """
+    For each centre (x, y, sigma), the columns of the fine grid within r_xy
+    lattice steps along x and y and r_sigma steps along log(sigma), at every
+    exponent. Centres outside the grid are moved to its edge. Rows are
+    padded with -1 where the neighbourhood leaves the fine grid or meets a
+    candidate the stimulus never reaches.
+    """
+
+    shape = np.array(lookup.shape[:3])
+    offsets = np.array(list(itertools.product(
+        range(-r_xy, r_xy + 1), range(-r_xy, r_xy + 1),
+        range(-r_sigma, r_sigma + 1))))
+    points = np.clip(_lattice_indices(*centres.T, params), 0, shape - 1)
+    points = points[:, None] + offsets
+    valid = ((points >= 0) & (points < shape)).all(axis=-1)
+    points = np.clip(points, 0, shape - 1)
+    cols = lookup[points[..., 0], points[..., 1], points[..., 2]]
+    cols[~valid] = -1
+    return cols.reshape(len(centres), -1)
+
+
+def coarse_neighbourhoods(coarse_grid, lookup, params=prf_params):
+
+    """
+    Fine grid neighbourhood of each coarse candidate, spanning half a coarse
+    step plus params['local_margin'] fine steps along each axis.
+    """
+
+    xy, sigmas = grid_axes(params)[:2]
+    coarse_xy, coarse_sigmas = grid_axes(coarse_params(params))[:2]
+    margin = params['local_margin']
+    r_xy = int(np.ceil((coarse_xy[1] - coarse_xy[0]) /
+                       (xy[1] - xy[0]) / 2)) + margin
+    r_sigma = int(np.ceil(np.log(coarse_sigmas[1] / coarse_sigmas[0]) /
+                          np.log(sigmas[1] / sigmas[0]) / 2)) + margin
+    return neighbourhoods(coarse_grid, lookup, r_xy, r_sigma, params)
+
+
+def _grid_search(data, predictions):
+
+    """
+    Best candidate per voxel by projection onto unit-norm predictions, as a
+    running maximum over blocks of candidates so that memory does not grow
+    with the grid size.
+    """
+
+    voxels = np.arange(len(data))
+    best = np.zeros(len(data), dtype=int)
+    scores = np.full(len(data), -np.inf, dtype=np.float32)
+    block = max(1, SEARCH_BLOCK // max(len(data), 1))
+    for start in range(0, len(predictions), block):
+        projections = data @ predictions[start:start + block].T
+        block_best = projections.argmax(axis=1)
+        block_scores = projections[voxels, block_best]
+        better = block_scores > scores
+        best[better] = block_best[better] + start
+        scores[better] = block_scores[better]
+    return best, scores
+
+
+def _local_search(data, groups, local_cols):
+
+    """
+    Fine grid search restricted to a neighbourhood per voxel. groups assigns
+    each voxel a row of local_cols, the fine grid columns to search. Voxels
+    in the same group are searched with a single matrix product, and those
+    whose neighbourhood holds no candidates search the full grid.
+    """
+
+    s = _shared
+    best = np.empty(len(data), dtype=int)
+    scores = np.empty(len(data), dtype=np.float32)
+    for group in np.unique(groups):
+        voxels = np.flatnonzero(groups == group)
+        cols = local_cols[group]
+        cols = cols[cols >= 0]
+        if not len(cols):
+            best[voxels], scores[voxels] = _grid_search(
+                data[voxels], s['predictions'])
+            continue
+        local_best, scores[voxels] = _grid_search(
+            data[voxels], s['predictions'][cols])
+        best[voxels] = cols[local_best]
+    return best, scores
+
+
+def _seeded_search(data, priors):
+
+    """
+    Searches the fine grid neighbourhood of each voxel's prior estimate
+    (x, y, sigma), e.g. from template retinotopy. Voxels whose priors fall
+    on the same lattice point share a neighbourhood. Priors beyond the grid
+    are first moved onto it, radially for the centre, so that peripheral
+    priors land on the edge of the grid disc rather than a corner of the
+    square lattice outside it.
+    """
+
+    s = _shared
+    xy, sigmas = grid_axes(s['params'])[:2]
+    x, y, sigma = priors.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.minimum(1, xy[-1] / np.hypot(x, y))
+    scale[~np.isfinite(scale)] = 1
+    sigma = np.clip(sigma, sigmas[0], sigmas[-1])
+    points, groups = np.unique(
+        _lattice_indices(x * scale, y * scale, sigma, s['params']), axis=0,
+        return_inverse=True)
+    points = np.clip(points, 0, np.array(s['lookup'].shape[:3]) - 1)
+    centres = np.column_stack([xy[points[:, 0]], xy[points[:, 1]],
+                               sigmas[points[:, 2]]])
+    local_cols = neighbourhoods(centres, s['lookup'],
+                                *s['params']['prior_radius'], s['params'])
+    return _local_search(data, groups.ravel(), local_cols)
+
+
+def _fit_chunk(chunk):
+
+    """
+    Grid search then refinement for a chunk of voxels. chunk holds the data
+    (voxels x time) and optional priors (voxels x [x, y, sigma], NaN where
+    there is no prior).
+    """
+
+    s = _shared
+    data, priors = chunk
+    data = residualise(data.T, s['drift']).T
+    data_norms = np.linalg.norm(data, axis=1)
+
+    # grid search: projection of data onto each unit-norm prediction
+    best = np.zeros(len(data), dtype=int)
+    scores = np.zeros(len(data), dtype=np.float32)
+    remaining = np.ones(len(data), dtype=bool)
+    if priors is not None:  # search around priors first
+        seeded = np.flatnonzero(~np.isnan(priors).any(axis=1))
+        if len(seeded):
+            best[seeded], scores[seeded] = _seeded_search(
+                data[seeded], priors[seeded])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = scores[seeded] / data_norms[seeded]
+            r2 = 100 * np.maximum(r, 0) ** 2
+            remaining[seeded[r2 >= s['params']['prior_min_r2']]] = False
+    todo = np.flatnonzero(remaining)  # no prior, or a poor seeded fit
+    if len(todo) and s['params']['search'] == 'coarse_to_fine':
+        coarse_best = _grid_search(data[todo], s['coarse_predictions'])[0]
+        best[todo], scores[todo] = _local_search(
+            data[todo], s['coarse_groups'][coarse_best],
+            s['coarse_neighbourhoods'])
+    elif len(todo):
+        best[todo], scores[todo] = _grid_search(data[todo], s['predictions'])
+    x, y, sigma, n = s['grid'][best].T
+
+    # nonlinear refinement
+    x, y, sigma, n, scores, norms = refine(
+        data, x, y, sigma, n, scores, s['params'])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.where(data_norms > 0, scores / data_norms, 0)
+        gain = np.where(norms > MIN_NORM, scores / norms, 0)
+    r = np.maximum(r, 0)  # only positive pRFs are considered
+    results = {'x': x, 'y': y, 'sigma': sigma, 'gain': gain,
+               'r2': 100 * r ** 2}
+    if s['params']['model'] == 'css':
+        results['n'] = n
+    return results
+
+
+def _grid_predictions(apertures, grid, hrf, drift, n_runs, TR, stim, params):
+
+    """
+    Unit-norm residualised predictions (candidates x time) for the grid,
+    dropping candidates the stimulus never reaches, as they cannot be fit.
+    Aperture overlaps are computed (or read from the cache) once per centre
+    and size, then shared by every exponent.
+    """
+
+    exponents = grid_axes(params)[2]
+    spatial = np.ascontiguousarray(grid[::len(exponents), :3])
+    if stim is None:
+        overlaps = make_overlaps(apertures, spatial, params)
+    else:
+        overlaps = cached_overlaps(
+            stim, apertures, spatial,
+            lambda: make_overlaps(apertures, spatial, params), params)
+    predictions = make_predictions(overlaps, exponents, hrf)
+    predictions = residualise(np.tile(predictions, (n_runs, 1)), drift)
+    norms = np.linalg.norm(predictions, axis=0)
+    keep = norms > MIN_NORM
+    predictions = np.ascontiguousarray((predictions[:, keep] / norms[keep]).T)
+    return grid[keep], predictions.astype(np.float32)
+
+
+def _shared_state(apertures, TR, n_runs, stim, params, priors):
+
+    """ Grid predictions and model settings needed by every worker """
+
+    T_run = apertures.shape[0]
+    fine_apertures = resample_apertures(apertures, params['aperture_res'])
+    res = params['aperture_res']
+    X, Y = visual_field(res, params['stim_radius_deg'])
+    hrf = spm_hrf(TR)
+    drift = drift_basis(T_run, n_runs, params['drift_degree'])
+    grid, predictions = _grid_predictions(
+        fine_apertures, make_grid(params), hrf, drift, n_runs, TR, stim,
+        params)
+
+    shared = {
+        'apertures': fine_apertures, 'X': X, 'Y': Y,
+        'pixel_area': (2 * params['stim_radius_deg'] / res) ** 2,
+        'hrf': hrf, 'drift': drift, 'n_runs': n_runs, 'grid': grid,
+        'predictions': predictions, 'params': params}
+    if params['search'] == 'coarse_to_fine' or priors is not None:
+        shared['lookup'] = lattice_lookup(grid, params)
+    if params['search'] == 'coarse_to_fine':
+        coarse = coarse_params(params)
+        coarse_grid, shared['coarse_predictions'] = _grid_predictions(
+            resample_apertures(apertures, coarse['aperture_res']),
+            make_grid(coarse), hrf, drift, n_runs, TR, stim, coarse)
+        # neighbourhoods of each coarse centre and size span all exponents
+        coarse_spatial, groups = np.unique(coarse_grid[:, :3], axis=0,
+                                           return_inverse=True)
+        shared['coarse_groups'] = groups.ravel()
+        shared['coarse_neighbourhoods'] = coarse_neighbourhoods(
+            coarse_spatial, shared['lookup'], params)
+    return shared
+
+
+def _fit_task(task):
+    i, chunk = task
+    return i, _fit_chunk(chunk)
+
+
+def _run_tasks(tasks, shared, num_procs):
+
+    """ Yields (chunk index, results) for each task as it finishes """
+
+    if num_procs == 1:
+        _init_worker(shared)
+        yield from map(_fit_task, tasks)
+    else:
+        # workers are started from a clean server process rather than forked
+        # from this one, whose other threads (e.g. prefetch reading the
+        # next session) may hold locks that a forked child would inherit.
+        # Large arrays reach them memory-mapped, shared between workers.
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                get_context('forkserver').Pool(
+                    num_procs, initializer=_init_worker,
+                    initargs=(_map_arrays(shared, tmp_dir),)) as pool:
+            yield from pool.imap_unordered(_fit_task, tasks)
+
+
+def fit_key(data, apertures, TR, n_runs, params=prf_params, priors=None):
+
+    """
+    Hash identifying a fit by its data, stimulus and settings, so that
+    checkpointed chunks are only reused for an identical fit.
+    """
+
+    spec = {'data': _digest(data), 'apertures': _digest(apertures),
+            'TR': float(TR), 'n_runs': int(n_runs), 'params': params,
+            'priors': None if priors is None else _digest(priors)}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str)
+                        .encode()).hexdigest()
+
+
+def save_checkpoint(results, path):
+
+    """ Writes a chunk's results atomically, so partial files never exist """
+
+    with atomic_write(path) as f:
+        np.savez(f, **results)
+
+
+def fit_prfs(data, apertures, TR, n_runs=1, num_procs=None, stim=None,
+             params=prf_params, priors=None, checkpoint_dir=None):
+
+    """
+    Fits a Gaussian (or, with params['model'] set to 'css', a compressive
+    spatial summation) pRF to every voxel. With params['search'] set to
+    'coarse_to_fine', each voxel is first matched against a coarse grid on
+    a downsampled aperture and then searched only in a local neighbourhood
+    of the fine grid, rather than exhaustively over the fine grid. If
+    priors are given, each voxel first searches only the fine grid around
+    its prior, falling back to the full search if the seeded fit explains
+    less than params['prior_min_r2'] percent of variance.
+
+    Voxels are fit in chunks of params['chunk_size']. If checkpoint_dir is
+    set, each finished chunk is saved there, and a rerun of the same fit
+    only fits the chunks that are missing.
+
+    Args:
+        data (np.ndarray): voxels x time matrix, n_runs runs concatenated
+        apertures (np.ndarray): time x res x res stimulus for a single run
+        TR (float): repetition time (s)
+        n_runs (int): number of runs concatenated in data
+        num_procs (int): worker processes, defaults to all cores
+        stim (str): stimulus name, if set grid predictions are read from and
+            stored in the prediction cache
+        params (dict): model parameters, see config.prf_params
+        priors (np.ndarray): voxels x [x, y, sigma] (deg) starting estimates,
+            NaN for voxels without one
+        checkpoint_dir (str): directory for per-chunk results
+
+    Returns:
+        results (dict): arrays of x, y, sigma, gain, r2 (percent variance
+            explained), polar angle (deg, counter-clockwise from the right
+            horizontal meridian), eccentricity (deg), rfsize (deg,
+            sigma / sqrt(n) as in analyzePRF) and, for the CSS model, the
+            exponent n for each voxel
+    """
+
+    num_procs = num_procs or os.cpu_count()
+    T_run = apertures.shape[0]
+    assert data.shape[1] == T_run * n_runs, \
+        'timeseries length does not match stimulus'
+    chunks = [(data[c:c + params['chunk_size']],
+               None if priors is None else priors[c:c + params['chunk_size']])
+              for c in range(0, len(data), params['chunk_size'])]
+
+    # reload chunks finished by an earlier, interrupted run of this fit
+    results = [None] * len(chunks)
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        key = fit_key(data, apertures, TR, n_runs, params, priors)
+        for path in glob.glob(f'{checkpoint_dir}/*.npz'):
+            if not op.basename(path).startswith(key):  # a different fit
+                os.remove(path)
+        paths = [f'{checkpoint_dir}/{key}_chunk-{i:05d}.npz'
+                 for i in range(len(chunks))]
+        for i, path in enumerate(paths):
+            if op.isfile(path):
+                with np.load(path) as f:
+                    results[i] = dict(f)
+
+    tasks = [(i, chunk) for i, chunk in enumerate(chunks)
+             if results[i] is None]
+    if len(tasks):
+        shared = _shared_state(apertures, TR, n_runs, stim, params, priors)
+        for i, chunk_results in _run_tasks(tasks, shared, num_procs):
+            results[i] = chunk_results
+            if checkpoint_dir is not None:
+                save_checkpoint(chunk_results, paths[i])
+
+    results = {key: np.concatenate([r[key] for r in results])
+               for key in results[0]}
+    results['ang'] = np.degrees(np.arctan2(results['y'], results['x'])) % 360
+    results['ecc'] = np.hypot(results['x'], results['y'])
+    results['rfsize'] = results['sigma'] / np.sqrt(results.get('n', 1))
+    return results
+
+
+def cross_validate_prfs(runs, apertures, TR, num_procs=None, stim=None,
+                        params=prf_params, checkpoint_dir=None):
+
+    """
+    Leave-one-run-out cross-validation. Training data for each fold is the
+    mean of the other runs, formed from a running sum over all runs. The
+    mean of all runs and every training fold are fit together in one call,
+    then each held-out run is scored against its fold's prediction in one
+    batched pass.
+
+    Args:
+        runs (np.ndarray): runs x voxels x time
+        apertures (np.ndarray): time x res x res stimulus for a single run
+        TR (float): repetition time (s)
+        num_procs (int): worker processes, defaults to all cores
+        stim (str): stimulus name, used for the prediction cache
+        params (dict): model parameters, see config.prf_params
+        checkpoint_dir (str): directory for per-chunk results, see fit_prfs
+
+    Returns:
+        results (dict): fit to the mean of all runs, as for fit_prfs
+        r2_cv (np.ndarray): percent variance of the held-out runs explained
+            by the fits to the remaining runs (negative if worse than the
+            held-out mean)
+    """
+
+    num_runs, num_voxels, T = runs.shape
+    assert num_runs > 1, 'cross-validation requires at least two runs'
+    total = runs.sum(axis=0)
+    data = np.concatenate([total[None] / num_runs,
+                           (total[None] - runs) / (num_runs - 1)])
+    fits = fit_prfs(data.reshape(-1, T), apertures, TR, 1, num_procs, stim,
+                    params, checkpoint_dir=checkpoint_dir)
+    results = {key: values[:num_voxels] for key, values in fits.items()}
+
+    # score each held-out run with the prediction of the fit to the others
+    folds = slice(num_voxels, None)
+    drift = drift_basis(T, 1, params['drift_degree'])
+    predictions = residualise(predict_timecourses(
+        fits['x'][folds], fits['y'][folds], fits['sigma'][folds],
+        apertures, TR, params, fits['n'][folds] if 'n' in fits else None),
+        drift) * fits['gain'][folds]
+    held_out = residualise(runs.reshape(-1, T).T, drift)
+    ss_res = ((held_out - predictions) ** 2).sum(axis=0)
+    ss_tot = (held_out ** 2).sum(axis=0)
+    ss_res = ss_res.reshape(num_runs, num_voxels).sum(axis=0)
+    ss_tot = ss_tot.reshape(num_runs, num_voxels).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2_cv = np.where(ss_tot > 0, 100 * (1 - ss_res / ss_tot), 0)
+    return results, r2_cv
+
+
+def save_map(values, indices, ref, path):
+
+    """ Writes per-voxel values as a float32 NIfTI in the space of ref """
+
+    header = ref.header.copy()
+    header.set_data_dtype(np.float32)
+    volume = unmask(values, indices, ref.shape[:3])
+    nib.save(nib.Nifti1Image(volume, ref.affine, header), path)
+
+
+def prf_maps(results):
+
+    """ Output maps (name: per-voxel or per-vertex values) of a pRF fit """
+
+    maps = {'polar_angle': results['ang'],
+            'eccentricity_deg': results['ecc'],
+            'rfsize_sigma_deg': results['rfsize'],
+            'r2': results['r2']}
+    if 'n' in results:
+        maps['exponent'] = results['n']
+    if 'r2_cv' in results:
+        maps['r2_cv'] = results['r2_cv']
+    return maps
+
+
+def _clear_results_mat(out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    if op.isfile(f'{out_dir}/prfs.mat'):
+        os.remove(f'{out_dir}/prfs.mat')
+
+
+def _save_results_mat(results, out_dir):
+    with atomic_write(f'{out_dir}/prfs.mat') as f:
+        scipy.io.savemat(f, results)
+
+
+def save_prf_maps(results, indices, ref, out_dir):
+
+    """
+    Writes pRF parameter maps as NIfTIs in the space of ref, with NaNs outside
+    the analysed mask, plus prfs.mat holding all estimates. CSS fits also
+    get an exponent map, cross-validated fits an r2_cv map. Any existing
+    prfs.mat is removed first and the new one written last and atomically,
+    so its presence marks a completed fit.
+
+    Args:
+        results (dict): output of fit_prfs
+        indices (np.ndarray): flat voxel indices in the order of results,
+            see masked_timeseries.mask_indices
+        ref (nib.Nifti1Image): image providing the affine and header
+        out_dir (str): output directory
+    """
+
+    _clear_results_mat(out_dir)
+    for name, values in prf_maps(results).items():
+        save_map(values, indices, ref, f'{out_dir}/{name}.nii')
+    _save_results_mat(results, out_dir)
+
+
+def save_prf_surface_maps(results, vertices, out_dir):
+
+    """
+    As save_prf_maps, for fits to surface vertices, writing {name}_lh.mgh
+    and {name}_rh.mgh overlays with NaNs at vertices that were not analysed.
+
+    Args:
+        results (dict): output of fit_prfs, lh vertices then rh vertices
+        vertices (dict): hemi -> (analysed vertices, number of vertices),
+            see surface_sampling.surface_projection
+        out_dir (str): output directory
+    """
+
+    _clear_results_mat(out_dir)
+    start = 0
+    for hemi in ['lh', 'rh']:
+        analysed, num_vertices = vertices[hemi]
+        rows = slice(start, start + len(analysed))
+        start += len(analysed)
+        for name, values in prf_maps(results).items():
+            overlay = np.full(num_vertices, np.nan, dtype=np.float32)
+            overlay[analysed] = values[rows]
+            save_mgh(overlay, f'{out_dir}/{name}_{hemi}.mgh')
+    _save_results_mat(results, out_dir)
@@ -0,0 +1,127 @@
+# /usr/bin/python
+"""
+Quality control images for registration and ROIs, rendered in-process with
+matplotlib instead of slicer/pngappend and fslstats/fsleyes. Each image
+loads its volumes once. Rendering is handed to a background thread pool
+(submit), so the pipeline carries on while images are written; wait_for_qc
+blocks until they are done and raises any error.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import sobel
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+SLICE_FRACTIONS = (.35, .45, .55, .65)  # as the slicer calls they replace
+EDGE_PERCENTILE = 90  # gradient magnitude percentile marking edges
+QC_THREADS = 4
+
+_executor = ThreadPoolExecutor(QC_THREADS)
+_futures = []
+
+
+def submit(function, *args, **kwargs):
+
+    """ Runs a rendering function in the background """
+
+    _futures.append(_executor.submit(function, *args, **kwargs))
+
+
+def wait_for_qc():
+
+    """ Waits for all submitted images, re-raising the first error """
+
+    while _futures:
+        _futures.pop(0).result()
+
+
+def _load(volume):
+    if isinstance(volume, str):
+        volume = nib.load(volume).get_fdata(dtype=np.float32)
+    return np.asarray(volume, dtype=np.float32).reshape(np.shape(volume)[:3])
+
+
+def _slice(volume, axis, index):
+
+    """ 2D slice for display, superior (or anterior) up """
+
+    return np.take(volume, index, axis=axis).T
+
+
+def _display_range(volume):
+    values = volume[volume > 0]
+    if not values.size:
+        return 0, 1
+    return tuple(np.percentile(values, [2, 98]))
+
+
+def _edges(image):
+    magnitude = np.hypot(sobel(image, 0), sobel(image, 1))
+    if not magnitude.any():
+        return magnitude > 0
+    return magnitude > np.percentile(magnitude[magnitude > 0],
+                                     EDGE_PERCENTILE)
+
+
+def edge_montage(image, reference, out_path, fractions=SLICE_FRACTIONS):
+
+    """
+    Registration check as slicer + pngappend: sagittal, coronal and axial
+    slices of image with the edges of reference in red (top row), then the
+    same with the two swapped (bottom row).
+
+    Args:
+        image, reference (str or np.ndarray): volumes on the same grid
+        out_path (str): PNG to write
+    """
+
+    volumes = [_load(image), _load(reference)]
+    ranges = [_display_range(v) for v in volumes]
+    positions = [(axis, int(f * volumes[0].shape[axis])) for axis in range(3)
+                 for f in fractions]
+    fig = Figure(figsize=(2 * len(positions), 4.4), facecolor='black')
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(2, len(positions))
+    for row, (shown, edged) in enumerate([(0, 1), (1, 0)]):
+        for ax, (axis, index) in zip(axes[row], positions):
+            ax.imshow(_slice(volumes[shown], axis, index), cmap='gray',
+                      vmin=ranges[shown][0], vmax=ranges[shown][1],
+                      origin='lower', interpolation='nearest')
+            edges = _edges(_slice(volumes[edged], axis, index))
+            ax.imshow(np.ma.masked_where(~edges, edges), cmap='autumn',
+                      origin='lower', interpolation='nearest')
+            ax.axis('off')
+    fig.subplots_adjust(0, 0, 1, 1, .02, .02)
+    fig.savefig(out_path, facecolor='black')
+
+
+def ortho_view(reference, mask, out_path):
+
+    """
+    Mask check as fsleyes render --scene ortho: sagittal, coronal and axial
+    slices through the mask's centre of gravity, over the reference
+    displayed from 0 to its maximum.
+
+    Args:
+        reference, mask (str or np.ndarray): volumes on the same grid
+        out_path (str): PNG to write
+    """
+
+    reference, mask = _load(reference), _load(mask)
+    weights = np.clip(mask, 0, None)
+    centre = [int(np.average(np.arange(n), weights=weights.sum(
+        axis=tuple(a for a in range(3) if a != axis)))) if weights.any()
+              else n // 2 for axis, n in enumerate(mask.shape)]
+    fig = Figure(figsize=(32, 6), facecolor='black')
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(1, 3)
+    for axis, ax in enumerate(axes):
+        ax.imshow(_slice(reference, axis, centre[axis]), cmap='gray', vmin=0,
+                  vmax=reference.max() or 1, origin='lower')
+        overlay = _slice(mask, axis, centre[axis])
+        ax.imshow(np.ma.masked_where(overlay <= 0, overlay), cmap='gray',
+                  vmin=0, vmax=1, origin='lower')
+        ax.axis('off')
+    fig.savefig(out_path, facecolor='black')
@@ -4,9 +4,10 @@ import os
 import os.path as op
 import glob
 import shutil
-import subprocess
 import json
 from .config import PROJ_DIR
+from .transforms import transform_volumes
+from .qc_montage import submit, edge_montage, wait_for_qc
 
 
 def registration(subjects=None, overwrite=[]):
@@ -66,14 +67,11 @@ def registration(subjects=None, overwrite=[]):
                       f'-searchry -90 90 '
                       f'-searchrz -90 90 '
                       f'-interp trilinear')
-        standard2highres = f'{fnirt_dir}/standard2highres.mat'
-        if not op.isfile(standard2highres) or 'anat_std' in overwrite:
-            os.system(f'convert_xfm -inverse '
-                      f'-omat {standard2highres} '
-                      f'{highres2standard}')
 
-        # non-linear
+        # non-linear (inverses and composites are derived when needed, see
+        # transforms.get_transform)
         highres2standard_warp = f'{fnirt_dir}/highres2standard_warp.nii.gz'
+        highres2standard_field = f'{fnirt_dir}/highres2standard_field.nii.gz'
         if not op.isfile(highres2standard_warp) or 'anat_std' in overwrite:
             os.system(f'fnirt '
                       f'--in={ref_anat} '
@@ -82,58 +80,28 @@ def registration(subjects=None, overwrite=[]):
                       f'--config=T1_2_MNI152_2mm '
                       f'--aff={highres2standard} '
                       f'--cout={highres2standard_warp} '
+                      f'--fout={highres2standard_field} '
                       f'--iout={fnirt_dir}/highres2standard_head '
                       f'--jout={fnirt_dir}/highres2highres_jac '
                       f'--warpres=10,10,10')
-        standard2highres_warp = f'{fnirt_dir}/standard2highres_warp.nii.gz'
-        if not op.isfile(standard2highres_warp) or 'anat_std' in overwrite:
-            os.system(f'invwarp '
-                      f'-w {highres2standard_warp} '
-                      f'-o {standard2highres_warp} '
-                      f'-r {ref_anat}')
-        
+        if not op.isfile(highres2standard_field):  # warps made before --fout
+            os.system(f'fnirtfileutils '
+                      f'--in={highres2standard_warp} '
+                      f'--ref={ref_std} '
+                      f'--out={highres2standard_field} '
+                      f'--withaff')
+
         # apply transform to ref anat
         highres2standard_img = f'{fnirt_dir}/highres2standard.nii.gz'
         if not op.isfile(highres2standard_img) or 'anat_std' in overwrite:
-            os.system(f'applywarp '
-                      f'-i {ref_anat_brain} '
-                      f'-r {ref_std_brain} '
-                      f'-o {highres2standard_img} '
-                      f'-w {highres2standard_warp}')
+            transform_volumes(subject, None, 'highres', 'standard',
+                              [ref_anat_brain], [highres2standard_img])
 
-        # make reg images
+        # make reg image (rendered in the background, see qc_montage)
         d = fnirt_dir
         if not op.isfile(f'{d}/highres2standard.png') or 'anat_std' in overwrite:
-            slicer_str = (
-                f'-x 0.35 {d}/sla.png -x 0.45 {d}/slb.png '
-                f'-x 0.55 {d}/slc.png -x 0.65 {d}/sld.png '
-                f'-y 0.35 {d}/sle.png -y 0.45 {d}/slf.png '
-                f'-y 0.55 {d}/slg.png -y 0.65 {d}/slh.png '
-                f'-z 0.35 {d}/sli.png -z 0.45 {d}/slj.png '
-                f'-z 0.55 {d}/slk.png -z 0.65 {d}/sll.png')
-            append_str = ' + '.join([f'{d}/sl{i}.png' for i in 'abcdefghijkl'])
-
-            cmd = f'slicer {d}/highres2standard {d}/standard -s 2 {slicer_str}'
-            subprocess.Popen(cmd.split()).wait()
-
-            cmd = f'pngappend {append_str} {d}/highres2standard1.png'
-            subprocess.Popen(cmd.split()).wait()
-
-            cmd = f'slicer {d}/standard {d}/highres2standard -s 2 {slicer_str}'
-            subprocess.Popen(cmd.split()).wait()
-
-            cmd = f'pngappend {append_str} {d}/highres2standard2.png'
-            subprocess.Popen(cmd.split()).wait()
-
-            cmd = (f'pngappend {d}/highres2standard1.png - '
-                   f'{d}/highres2standard2.png {d}/highres2standard.png')
-            subprocess.Popen(cmd.split()).wait()
-
-        # clean up
-        for search in ['*1.png', '*2.png', 'sl?.png']:
-            imgs = glob.glob(f'{d}/{search}')
-            for img in imgs:
-                os.remove(img)
+            submit(edge_montage, f'{d}/highres2standard.nii.gz',
+                   ref_std_brain, f'{d}/highres2standard.png')
 
         # transform 2: between anatomical space and functional space
         for session in sessions:
@@ -166,7 +134,7 @@ def registration(subjects=None, overwrite=[]):
                     func_scan = func_scans[len(func_scans) // 2]
                     out_path = f'{reg_dir}/example_func.nii.gz'
                     os.system(f'fslmaths {func_scan} -Tmean {out_path}')
-            ref_func = out_path
+            ref_func = glob.glob(f'{reg_dir}/example_func.nii*')[0]
 
             # make freesurfer reg for surface maps
             lta = f'{reg_dir}/example_func2highres.lta'
@@ -195,69 +163,19 @@ def registration(subjects=None, overwrite=[]):
                     # os.system(f'flirt -in {ref_anat_brain} -ref {ref_func}
                     #     -omat {highres2example_func}')
 
-                highres2example_func = f'{reg_dir}/highres2example_func.mat'
-                if not op.isfile(highres2example_func) or 'func_anat' in overwrite:
-                    os.system(f'convert_xfm '
-                              f'-omat {highres2example_func} '
-                              f'-inverse '
-                              f'{example_func2highres}')
-
+            # other directions, e.g. highres -> func, are derived from the
+            # lta when needed, see transforms.get_transform
 
-            elif method == 'freesurfer':
-
-                example_func2highres = f'{reg_dir}/example_func2highres.mat'
-                if not op.isfile(example_func2highres) or 'func_anat' in overwrite:
-                    os.system(f'lta_convert '
-                              f'--inlta {lta} '
-                              f'--outfsl {example_func2highres} '
-                              f'--src {ref_func} '
-                              f'--trg {ref_anat}')
-
-                lta_inv = f'{reg_dir}/highres2example_func.lta'
-                if not op.isfile(lta_inv) or 'func_anat' in overwrite:
-                    os.system(f'lta_convert '
-                              f'--inlta {lta} '
-                              f'--outlta {lta_inv} '
-                              f'--invert')
-
-                highres2example_func = f'{reg_dir}/highres2example_func.mat'
-                if not op.isfile(highres2example_func) or 'func_anat' in overwrite:
-                    os.system(f'lta_convert '
-                              f'--inlta {lta_inv} '
-                              f'--outfsl {highres2example_func} '
-                              f'--src {ref_anat} '
-                              f'--trg {ref_func}')
-
-            # make reg images
+            # make reg image (rendered in the background, see qc_montage)
             d = reg_dir
             if (not op.isfile(f'{d}/example_func2highres.png') or 'func_anat' in
                     overwrite):
-                slicer_str = (
-                    f'-x 0.35 {d}/sla.png -x 0.45 {d}/slb.png '
-                    f'-x 0.55 {d}/slc.png -x 0.65 {d}/sld.png '
-                    f'-y 0.35 {d}/sle.png -y 0.45 {d}/slf.png '
-                    f'-y 0.55 {d}/slg.png -y 0.65 {d}/slh.png '
-                    f'-z 0.35 {d}/sli.png -z 0.45 {d}/slj.png '
-                    f'-z 0.55 {d}/slk.png -z 0.65 {d}/sll.png')
-                append_str = ' + '.join(
-                    [f'{d}/sl{i}.png' for i in 'abcdefghijkl'])
-
-                cmd = f'slicer {d}/example_func2highres {d}/highres -s 2 {slicer_str}'
-                subprocess.Popen(cmd.split()).wait()
-
-                cmd = f'pngappend {append_str} {d}/example_func2highres1.png'
-                subprocess.Popen(cmd.split()).wait()
-
-                cmd = (f'slicer {d}/highres {d}/example_func2highres -s 2'
-                       f' {slicer_str}')
-                subprocess.Popen(cmd.split()).wait()
-
-                cmd = f'pngappend {append_str} {d}/example_func2highres2.png'
-                subprocess.Popen(cmd.split()).wait()
-
-                cmd = (f'pngappend {d}/example_func2highres1.png - '
-                       f'{d}/example_func2highres2.png {d}/example_func2highres.png')
-                subprocess.Popen(cmd.split()).wait()
+                func2highres_img = f'{d}/example_func2highres.nii.gz'
+                if not op.isfile(func2highres_img) or 'func_anat' in overwrite:
+                    transform_volumes(subject, session, 'func', 'highres',
+                                      [ref_func], [func2highres_img])
+                submit(edge_montage, func2highres_img, ref_anat,
+                       f'{d}/example_func2highres.png')
 
 
 if __name__ == "__main__":
@@ -266,3 +184,4 @@ if __name__ == "__main__":
     overwrite = []  # ['func_anat', 'anat_std', 'func_std']
     os.chdir(PROJ_DIR)
     registration(None, overwrite)
+    wait_for_qc()
@@ -0,0 +1,136 @@
+# /usr/bin/python
+"""
+In-process affine resampling of volumes between anatomical and functional
+space, in place of flirt -applyxfm and mri_vol2vol. Transforms are read from
+FSL (.mat) or FreeSurfer (.lta) files and converted to a map from each
+reference voxel to its position in the source volume. These coordinates
+depend only on the two voxel grids and the transform, so they are stored
+next to the transform and reused by every volume sent to the same grid.
+"""
+
+import os.path as op
+import hashlib
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import map_coordinates
+from .surface_sampling import read_lta
+from .atomic import atomic_write
+
+CHUNK_VOXELS = 2 ** 20  # reference voxels interpolated at a time
+
+
+def fsl_scaled(img):
+
+    """
+    Voxel -> FSL scaled mm coordinates, the space in which FSL .mat files
+    are defined. Voxels are scaled by their size, with x flipped if the
+    voxel to world matrix has a positive determinant (neurological order).
+    """
+
+    shape, zooms = img.shape[:3], img.header.get_zooms()[:3]
+    scaled = np.diag([*zooms, 1.])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0], flip[0, 3] = -1, shape[0] - 1
+        scaled = scaled @ flip
+    return scaled
+
+
+def ref2src_voxels(src, ref, transform, invert=False):
+
+    """
+    Args:
+        src (nibabel image): volume to be resampled
+        ref (nibabel image): volume defining the output grid
+        transform (str): FSL .mat or FreeSurfer .lta mapping src to ref
+        invert (bool): transform maps ref to src instead (as --inv in
+            mri_vol2vol)
+
+    Returns:
+        ref2src (np.ndarray): 4 x 4 matrix from ref voxels to src voxels
+    """
+
+    if transform.endswith('.lta'):
+        src2ref = read_lta(transform)
+        to_src, from_ref = np.linalg.inv(src.affine), ref.affine
+    else:
+        src2ref = np.loadtxt(transform)
+        to_src, from_ref = np.linalg.inv(fsl_scaled(src)), fsl_scaled(ref)
+    ref2src = src2ref if invert else np.linalg.inv(src2ref)
+    return to_src @ ref2src @ from_ref
+
+
+def source_coords(src, ref, transform, invert=False):
+
+    """ Position in src (voxels) of each ref voxel, 3 x voxels (x fastest) """
+
+    ref2src = ref2src_voxels(src, ref, transform, invert)
+    ijk = np.indices(ref.shape[:3], dtype=np.float32).reshape(3, -1,
+                                                              order='F')
+    return (ref2src[:3, :3] @ ijk + ref2src[:3, 3:]).astype(np.float32)
+
+
+def cached_source_coords(src, ref, transform, invert=False):
+
+    """
+    source_coords, stored next to the transform and keyed by both voxel
+    grids, the transform and its direction. Recomputed if the transform has
+    changed since.
+    """
+
+    spec = [src.shape[:3], src.affine, ref.shape[:3], ref.affine,
+            open(transform, 'rb').read(), invert]
+    key = hashlib.sha1(repr(spec).encode()).hexdigest()[:16]
+    path = f'{op.splitext(transform)[0]}_coords-{key}.npy'
+    if not op.isfile(path) or op.getmtime(path) < op.getmtime(transform):
+        coords = source_coords(src, ref, transform, invert)
+        with atomic_write(path) as f:
+            np.save(f, coords)
+    return np.load(path, mmap_mode='r')
+
+
+def resample(in_path, ref_path, transform, out_path=None, order=1,
+             thresh=None, invert=False):
+
+    """
+    Resamples a volume into the grid of a reference volume, as flirt
+    -applyxfm (order=1) or mri_vol2vol --nearest (order=0). Points outside
+    the source volume are 0. If thresh is given, the output is binarised
+    (value > thresh) as each chunk is interpolated, e.g. thresh=0 for
+    flirt ... && fslmaths -bin.
+
+    Args:
+        in_path (str): volume to resample
+        ref_path (str): volume defining the output grid
+        transform (str): FSL .mat or FreeSurfer .lta, see ref2src_voxels
+        out_path (str): optionally save the result with ref's geometry
+        order (int): 0 nearest neighbour, 1 trilinear
+        thresh (float): binarise the output at this value
+        invert (bool): see ref2src_voxels
+
+    Returns:
+        data (np.ndarray): resampled volume, uint8 if thresholded
+    """
+
+    src, ref = nib.load(in_path), nib.load(ref_path)
+    data = np.asarray(src.dataobj)
+    if order:
+        data = data.astype(np.float32)
+    coords = cached_source_coords(src, ref, transform, invert)
+    out = np.empty(coords.shape[1], dtype=data.dtype if thresh is None
+                   else np.uint8)
+    for start in range(0, len(out), CHUNK_VOXELS):
+        chunk = slice(start, start + CHUNK_VOXELS)
+        values = map_coordinates(data, coords[:, chunk], order=order,
+                                 mode='constant', cval=0)
+        out[chunk] = values if thresh is None else values > thresh
+    out = out.reshape(ref.shape[:3], order='F')
+
+    if out_path is not None:
+        header = ref.header.copy() if isinstance(ref, nib.Nifti1Image) \
+            else None
+        if header is not None:
+            header.set_data_dtype(out.dtype)
+            header.set_slope_inter(1, 0)
+        nib.save(nib.Nifti1Image(out, ref.affine, header), out_path)
+    return out
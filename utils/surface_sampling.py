@@ -0,0 +1,223 @@
+# /usr/bin/python
+"""
+Sampling of functional volumes at cortical surface vertices, in-process.
+Each vertex is sampled at points between its white and pial surface
+positions, mapped into the functional volume through the subject's
+FreeSurfer registration (example_func2highres.lta), and the nearest voxel
+to each point is taken. Averaging over these voxels gives a vertex's value,
+as mri_vol2surf --interp nearest --projfrac-avg would. The vertex -> voxel
+indices are computed once per session and hemisphere and stored on disk,
+so projecting a volume is a single array lookup.
+"""
+
+import os
+import os.path as op
+import glob
+import numpy as np
+import nibabel as nib
+import scipy.sparse
+from .config import surface_params
+from .atomic import atomic_write
+
+
+def read_lta(path):
+
+    """
+    Reads a FreeSurfer linear transform array (.lta).
+
+    Returns:
+        ras2ras (np.ndarray): 4 x 4 matrix mapping scanner RAS coordinates of
+            the source volume to those of the destination volume
+    """
+
+    lines = [line.split('#')[0].strip() for line in open(path)]
+    lines = [line for line in lines if line]
+    xform_type = int(lines[0].split('=')[1])
+    start = lines.index('1 4 4') + 1
+    matrix = np.array([line.split() for line in lines[start:start + 4]],
+                      dtype=float)
+    if xform_type == 1:  # LINEAR_RAS_TO_RAS
+        return matrix
+
+    # LINEAR_VOX_TO_VOX, convert using the volume geometry stored in the file
+    geometry = {}
+    for line in lines[start + 4:]:
+        if line in ['src volume info', 'dst volume info']:
+            volume = geometry.setdefault(line.split()[0], {})
+        elif '=' in line:
+            key, value = [s.strip() for s in line.split('=', 1)]
+            volume[key] = value
+    src, dst = [_vox2ras(geometry[v]) for v in ['src', 'dst']]
+    return dst @ matrix @ np.linalg.inv(src)
+
+
+def _vox2ras(volume):
+
+    """ Scanner vox2ras matrix from an LTA volume info block """
+
+    dims = np.array(volume['volume'].split(), dtype=float)
+    sizes = np.array(volume['voxelsize'].split(), dtype=float)
+    axes = np.array([volume[a].split() for a in ['xras', 'yras', 'zras']],
+                    dtype=float).T
+    c_ras = np.array(volume['cras'].split(), dtype=float)
+    M = axes * sizes
+    vox2ras = np.eye(4)
+    vox2ras[:3, :3] = M
+    vox2ras[:3, 3] = c_ras - M @ (dims / 2)
+    return vox2ras
+
+
+def vertex_voxels(subject, hemi, ref_func, reg,
+                  fractions=surface_params['fractions']):
+
+    """
+    Nearest functional voxel to each sampling point of each vertex.
+
+    Args:
+        subject (str): subject ID, without the 'sub-' prefix
+        hemi (str): 'lh' or 'rh'
+        ref_func (str): functional volume defining the voxel grid
+        reg (str): LTA from ref_func to the freesurfer anatomy, or None if
+            ref_func is already in the anatomy's space (e.g. orig.mgz)
+        fractions (tuple): sampling points as fractions of cortical thickness
+            (0 = white surface, 1 = pial surface)
+
+    Returns:
+        voxels (np.ndarray): vertices x fractions flat (x fastest) voxel
+            indices, -1 where a point falls outside the volume
+    """
+
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    white = nib.freesurfer.read_geometry(f'{fs_subj_dir}/surf/{hemi}.white')[0]
+    pial = nib.freesurfer.read_geometry(f'{fs_subj_dir}/surf/{hemi}.pial')[0]
+
+    # surface (tkr RAS) -> anatomical scanner RAS -> functional voxel
+    orig = nib.load(f'{fs_subj_dir}/mri/orig.mgz')
+    tkr2scanner = orig.affine @ np.linalg.inv(orig.header.get_vox2ras_tkr())
+    func = nib.load(ref_func)
+    anat2func = np.eye(4) if reg is None else np.linalg.inv(read_lta(reg))
+    surf2vox = np.linalg.inv(func.affine) @ anat2func @ tkr2scanner
+
+    shape = np.array(func.shape[:3])
+    voxels = np.empty((len(white), len(fractions)), dtype=int)
+    for f, fraction in enumerate(fractions):
+        points = white + fraction * (pial - white)
+        ijk = np.rint(points @ surf2vox[:3, :3].T + surf2vox[:3, 3]).astype(
+            int)
+        inside = ((ijk >= 0) & (ijk < shape)).all(axis=1)
+        voxels[:, f] = np.where(inside, np.ravel_multi_index(
+            np.clip(ijk, 0, shape - 1).T, shape, order='F'), -1)
+    return voxels
+
+
+def cached_vertex_voxels(subject, session, hemi, fractions=(0.,)):
+
+    """
+    vertex_voxels for a session's reference functional volume, stored in the
+    session's registration directory. Recomputed only if the surfaces,
+    anatomy, registration or reference volume have changed since. The
+    default samples the white surface only, as mri_vol2surf does.
+    """
+
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    reg_dir = f'derivatives/registration/sub-{subject}/{session}'
+    ref_func = glob.glob(f'{reg_dir}/example_func.nii*')[0]
+    reg = f'{reg_dir}/example_func2highres.lta'
+    tag = '-'.join(f'{fraction:g}' for fraction in fractions)
+    path = f'{reg_dir}/vertex_voxels_{hemi}_projfrac-{tag}.npy'
+    sources = [f'{fs_subj_dir}/surf/{hemi}.white',
+               f'{fs_subj_dir}/surf/{hemi}.pial',
+               f'{fs_subj_dir}/mri/orig.mgz', reg, ref_func]
+    if (not op.isfile(path) or
+            op.getmtime(path) < max(op.getmtime(s) for s in sources)):
+        voxels = vertex_voxels(subject, hemi, ref_func, reg, fractions)
+        with atomic_write(path) as f:
+            np.save(f, voxels.astype(np.int32))
+    return np.load(path)
+
+
+def vol2surf(volume, subject, session, hemi, fractions=(0.,)):
+
+    """
+    In-process equivalent of mri_vol2surf --interp nearest (averaging over
+    fractions of cortical thickness if several are given) for a volume in
+    the session's functional space. Points outside the volume contribute
+    0, as in mri_vol2surf.
+
+    Args:
+        volume (str or np.ndarray): path to, or data of, a 3D volume
+        subject (str): subject ID, without the 'sub-' prefix
+        session (str): session directory name
+        hemi (str): 'lh' or 'rh'
+        fractions (tuple): see vertex_voxels
+
+    Returns:
+        values (np.ndarray): value at each vertex
+    """
+
+    if isinstance(volume, str):
+        volume = np.asarray(nib.load(volume).dataobj)
+    values = np.asarray(volume, dtype=np.float32).ravel(order='F')
+    voxels = cached_vertex_voxels(subject, session, hemi, fractions)
+    return np.where(voxels >= 0, values[voxels], 0).mean(axis=1)
+
+
+def projection_matrix(voxels):
+
+    """
+    Sparse operator averaging each vertex's sampled voxels.
+
+    Args:
+        voxels (np.ndarray): vertices x samples voxel indices, see
+            vertex_voxels
+
+    Returns:
+        projection (scipy.sparse.csr_matrix): vertices x columns weights
+        columns (np.ndarray): sorted unique voxel indices that the columns of
+            projection refer to, so vertex data = projection @ data[columns]
+    """
+
+    valid = voxels >= 0
+    columns, cols = np.unique(voxels[valid], return_inverse=True)
+    rows = np.nonzero(valid)[0]
+    weights = 1 / valid.sum(axis=1)[rows]
+    projection = scipy.sparse.csr_matrix(
+        (weights.astype(np.float32), (rows, cols.ravel())),
+        shape=(len(voxels), len(columns)))
+    return projection, columns
+
+
+def surface_projection(subject, session, mask,
+                       fractions=surface_params['fractions']):
+
+    """
+    Projection of a session's functional data onto the vertices of both
+    hemispheres that sample at least one voxel inside mask.
+
+    Returns:
+        vertices (dict): hemi -> (analysed vertex indices, number of vertices
+            in the hemisphere). Rows of projection list the analysed lh
+            vertices, then the analysed rh vertices.
+        projection (scipy.sparse.csr_matrix): analysed vertices x columns
+        columns (np.ndarray): flat voxel indices to read, see
+            masked_timeseries.load_indexed_timeseries
+    """
+
+    in_mask = np.asarray(nib.load(mask).dataobj).ravel(order='F') > 0
+    vertices, sampled = {}, []
+    for hemi in ['lh', 'rh']:
+        voxels = cached_vertex_voxels(subject, session, hemi, fractions)
+        analysed = np.flatnonzero(
+            np.where(voxels >= 0, in_mask[voxels], False).any(axis=1))
+        vertices[hemi] = (analysed, len(voxels))
+        sampled.append(voxels[analysed])
+    projection, columns = projection_matrix(np.concatenate(sampled))
+    return vertices, projection, columns
+
+
+def save_mgh(values, path):
+
+    """ Writes per-vertex values as a float32 surface overlay (.mgh) """
+
+    data = np.asarray(values, dtype=np.float32).reshape(-1, 1, 1)
+    nib.save(nib.MGHImage(data, np.eye(4)), path)
@@ -0,0 +1,109 @@
+# /usr/bin/python
+"""
+Smoothing of surface pRF maps. Each step replaces a vertex's value with the
+mean over itself and its neighbours on the mesh, as freeview's
+overlay_smooth does, applied as a sparse matrix product to all maps of a
+hemisphere at once. The operator is built once per subject and hemisphere
+and stored. Polar angle is smoothed as complex unit vectors, so the 0/360
+boundary needs no special treatment, and vertices without a value (NaN)
+are left out of their neighbours' means.
+"""
+
+import os
+import os.path as op
+import numpy as np
+import nibabel as nib
+import scipy.sparse
+from .config import surface_params
+from .surface_sampling import save_mgh
+from .atomic import atomic_write
+
+
+def smoothing_operator(subject, hemi):
+
+    """
+    Sparse vertices x vertices matrix averaging each vertex with its
+    neighbours, stored as surf/{hemi}.smoothing_operator.npz in the
+    subject's freesurfer directory and rebuilt if the surface has changed.
+
+    Args:
+        subject (str): subject ID, without the 'sub-' prefix
+        hemi (str): 'lh' or 'rh'
+    """
+
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    surface = f'{fs_subj_dir}/surf/{hemi}.white'
+    path = f'{fs_subj_dir}/surf/{hemi}.smoothing_operator.npz'
+    if op.isfile(path) and op.getmtime(path) >= op.getmtime(surface):
+        return scipy.sparse.load_npz(path)
+
+    coords, faces = nib.freesurfer.read_geometry(surface)
+    n = len(coords)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]],
+                            faces[:, [2, 0]]])
+    edges = np.concatenate([edges, edges[:, ::-1], np.tile(np.arange(n),
+                                                           (2, 1)).T])
+    adjacency = scipy.sparse.coo_matrix(
+        (np.ones(len(edges), dtype=np.float32), (edges[:, 0], edges[:, 1])),
+        shape=(n, n)).tocsr()
+    adjacency.data[:] = 1  # edges shared by two faces
+    operator = scipy.sparse.diags(1 / adjacency.sum(axis=1).A1) @ adjacency
+    operator = operator.astype(np.float32).tocsr()
+    with atomic_write(path) as f:
+        scipy.sparse.save_npz(f, operator)
+    return operator
+
+
+def smooth(values, operator, steps=surface_params['smooth_steps'],
+           circular=False):
+
+    """
+    Args:
+        values (np.ndarray): vertices (x maps), NaN where there is no value
+        operator (scipy.sparse.csr_matrix): see smoothing_operator
+        steps (int): smoothing steps
+        circular (bool): values are angles in degrees
+
+    Returns:
+        smoothed (np.ndarray): as values, NaN only where no vertex within
+            steps has a value
+    """
+
+    values = np.asarray(values, dtype=np.float32)
+    valid = np.isfinite(values)
+    weight = valid.astype(np.float32)
+    total = np.where(valid, values, 0)
+    if circular:
+        total = np.exp(1j * np.radians(total)).astype(np.complex64) * valid
+    for _ in range(steps):
+        total = operator @ total
+        weight = operator @ weight
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed = np.degrees(np.angle(total)) % 360 if circular else \
+            total / weight
+    return np.where(weight > 0, smoothed, np.nan).astype(np.float32)
+
+
+def smooth_surface_maps(subject, prf_dir, parameters, overwrite=False):
+
+    """
+    Writes {parameter}_smoothed_{hemi}.mgh for each {parameter}_{hemi}.mgh
+    in prf_dir, all parameters of a hemisphere in one pass.
+    """
+
+    for hemi in ['lh', 'rh']:
+        outputs = [f'{prf_dir}/{p}_smoothed_{hemi}.mgh' for p in parameters]
+        if all(op.isfile(o) for o in outputs) and not overwrite:
+            continue
+        print(f'Smoothing {hemi} surface maps...')
+        operator = smoothing_operator(subject, hemi)
+        maps = np.column_stack([
+            np.asarray(nib.load(f'{prf_dir}/{p}_{hemi}.mgh').dataobj).ravel()
+            for p in parameters])
+        angles = np.array([p == 'polar_angle' for p in parameters])
+        smoothed = np.empty_like(maps, dtype=np.float32)
+        smoothed[:, ~angles] = smooth(maps[:, ~angles], operator)
+        smoothed[:, angles] = smooth(maps[:, angles], operator,
+                                     circular=True)
+        for values, output in zip(smoothed.T, outputs):
+            save_mgh(values, output)
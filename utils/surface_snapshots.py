@@ -0,0 +1,183 @@
+# /usr/bin/python
+"""
+Headless snapshots of surface pRF maps for quality control, in place of
+opening freeview for each subject, session and hemisphere. Each
+hemisphere's inflated surface is drawn on a matplotlib Agg canvas, leaving
+the global backend alone, from fixed camera angles, showing polar angle,
+eccentricity and r2 within the r2 mask, with the outlines of the V1-V3
+labels. Panels are rendered in parallel
+worker processes and stacked into one contact sheet for the cohort.
+"""
+
+import os
+import os.path as op
+import glob
+from multiprocessing import Pool
+import numpy as np
+import nibabel as nib
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.image import imread, imsave
+from .config import PROJ_DIR
+from .labels import read_label
+
+# camera azimuth and elevation (deg) of each view, for the left hemisphere;
+# azimuth is mirrored for the right
+VIEWS = {'medial': (0, 0), 'posterior': (-90, 0), 'inferior': (-90, -90)}
+OVERLAYS = {  # colormap, range
+    'polar_angle': ('hsv', (0, 360)),
+    'eccentricity_deg': ('jet', (0, 9)),
+    'r2': ('hot', (0, 100))}
+AREAS = ['V1', 'V2v', 'V2d', 'V3v', 'V3d']
+
+
+def camera(azimuth, elevation):
+
+    """ Rotation taking world coordinates to (screen x, screen y, depth) """
+
+    az, el = np.radians(azimuth), np.radians(elevation)
+    view = np.array([np.cos(el) * np.cos(az), np.cos(el) * np.sin(az),
+                     np.sin(el)])  # towards the camera
+    up = np.array([0, 0, 1.]) if abs(elevation) < 89 else \
+        np.array([-np.sign(elevation) * np.cos(az), -np.sign(elevation) *
+                  np.sin(az), 0])
+    right = np.cross(up, view)
+    right /= np.linalg.norm(right)
+    return np.stack([right, np.cross(view, right), view])
+
+
+def render_view(ax, coords, faces, colors, azimuth, elevation):
+
+    """
+    Draws the front-facing faces of a mesh, far to near, with their colours
+    (faces x RGBA) in orthographic projection.
+    """
+
+    screen = coords @ camera(azimuth, elevation).T
+    tris = screen[faces]
+    normal = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    front = np.flatnonzero(normal[:, 2] > 0)
+    front = front[np.argsort(tris[front, :, 2].mean(axis=1))]
+    ax.add_collection(PolyCollection(tris[front, :, :2],
+                                     facecolors=colors[front],
+                                     edgecolors='none', antialiased=False))
+    ax.set_xlim(screen[:, 0].min(), screen[:, 0].max())
+    ax.set_ylim(screen[:, 1].min(), screen[:, 1].max())
+    ax.set_aspect('equal')
+    ax.axis('off')
+
+
+def _read_overlay(prf_dir, name, hemi):
+    path = f'{prf_dir}/{name}_smoothed_{hemi}.mgh'
+    if not op.isfile(path):
+        path = f'{prf_dir}/{name}_{hemi}.mgh'
+    return np.asarray(nib.load(path).dataobj).ravel()
+
+
+def face_colors(faces, values, cmap, value_range, curv, mask, outline):
+
+    """
+    Face colours: the overlay where all vertices are in mask, binary
+    curvature elsewhere and white where a face crosses a label boundary.
+    """
+
+    colors = np.where((curv > 0)[:, None], .35, .65) * np.ones(4)
+    colors[:, 3] = 1
+    shown = mask & np.isfinite(values)
+    scaled = (np.nan_to_num(values) - value_range[0]) / np.ptp(value_range)
+    colors[shown] = matplotlib.colormaps[cmap](np.clip(scaled[shown], 0, 1))
+    face = colors[faces].mean(axis=1)
+    face[outline] = 1
+    return face
+
+
+def render_panel(job):
+
+    """
+    Renders one subject, session and hemisphere: overlays in rows, views in
+    columns, saved to {prf_dir}/snapshots_{hemi}.png.
+
+    Args:
+        job (tuple): (subject, session, hemi, prf_dir)
+    """
+
+    subject, session, hemi, prf_dir = job
+    fs_subj_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    roi_dir = f'derivatives/ROIs/sub-{subject}/{session}'
+    coords, faces = nib.freesurfer.read_geometry(
+        f'{fs_subj_dir}/surf/{hemi}.inflated')
+    curv = nib.freesurfer.read_morph_data(f'{fs_subj_dir}/surf/{hemi}.curv')
+    mask = np.zeros(len(coords), dtype=bool)
+    mask_path = f'{roi_dir}/mask_r2_thresh_{hemi}.label'
+    if op.isfile(mask_path):
+        mask[read_label(mask_path)[0]] = True
+    else:
+        mask[:] = True
+
+    # outline manual labels if present, else the drafts
+    outline = np.zeros(len(faces), dtype=bool)
+    for area in AREAS:
+        paths = [f'{fs_subj_dir}/label/{hemi}.tong.{area}.label',
+                 f'{roi_dir}/{hemi}.tong_draft.{area}.label']
+        paths = [p for p in paths if op.isfile(p)]
+        if paths:
+            in_label = np.zeros(len(coords), dtype=bool)
+            in_label[read_label(paths[0])[0]] = True
+            members = in_label[faces].sum(axis=1)
+            outline |= (members > 0) & (members < 3)
+
+    fig = Figure(figsize=(3 * len(VIEWS), 3 * len(OVERLAYS)))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(len(OVERLAYS), len(VIEWS))
+    for row, (name, (cmap, value_range)) in zip(axes, OVERLAYS.items()):
+        colors = face_colors(faces, _read_overlay(prf_dir, name, hemi), cmap,
+                             value_range, curv, mask, outline)
+        for ax, (view, (azimuth, elevation)) in zip(row, VIEWS.items()):
+            if hemi == 'rh':
+                azimuth = 180 - azimuth
+            render_view(ax, coords, faces, colors, azimuth, elevation)
+            ax.set_title(f'{name}, {view}', fontsize=8)
+    fig.suptitle(f'sub-{subject} {session} {hemi}')
+    fig.tight_layout()
+    out_path = f'{prf_dir}/snapshots_{hemi}.png'
+    fig.savefig(out_path, dpi=100)
+    return out_path
+
+
+def contact_sheet(fit_dir='mean_before_prf', num_procs=None,
+                  out_path='derivatives/pRF/retinotopy_contact_sheet.png',
+                  overwrite=False):
+
+    """
+    Renders panels for every session with surface pRF maps in parallel and
+    stacks them (left hemisphere beside right) into one image.
+    """
+
+    jobs = []
+    for prf_dir in sorted(glob.glob(f'derivatives/pRF/sub-*/*/{fit_dir}')):
+        subject = prf_dir.split('/')[2].split('-')[1]
+        session = prf_dir.split('/')[3]
+        if all(op.isfile(f'{prf_dir}/{name}_{hemi}.mgh') for name in OVERLAYS
+               for hemi in ['lh', 'rh']):
+            jobs += [(subject, session, hemi, prf_dir) for hemi in
+                     ['lh', 'rh']]
+    todo = [job for job in jobs if overwrite or
+            not op.isfile(f'{job[3]}/snapshots_{job[2]}.png')]
+    if todo:
+        print(f'Rendering {len(todo)} surface snapshot panels...')
+        with Pool(num_procs) as pool:
+            pool.map(render_panel, todo)
+    if not jobs:
+        return
+
+    panels = [imread(f'{job[3]}/snapshots_{job[2]}.png') for job in jobs]
+    rows = [np.concatenate(panels[i:i + 2], axis=1)
+            for i in range(0, len(panels), 2)]
+    imsave(out_path, np.concatenate(rows, axis=0))
+
+
+if __name__ == "__main__":
+    os.chdir(PROJ_DIR)
+    contact_sheet()
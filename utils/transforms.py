@@ -0,0 +1,385 @@
+# /usr/bin/python
+"""
+Registry of the transforms between a session's functional space ('func'),
+the subject's anatomy ('highres') and MNI152 2 mm space ('standard').
+Only the registrations themselves are read from disk (bbregister's
+example_func2highres.lta and FNIRT's highres2standard field); inverses and
+composites are derived here on request instead of with convert_xfm,
+lta_convert and invwarp. Derived transforms are written to disk so later
+processes reuse them, and the most recently used are kept in memory, once
+per subject for those not involving func.
+
+Transforms map world (scanner mm) coordinates. An affine is a 4 x 4 matrix
+from source to destination. A nonlinear transform is a Warp, holding for
+each voxel of the destination grid the world coordinates it samples in the
+source, which is the form needed to resample volumes.
+"""
+
+import os
+import os.path as op
+import glob
+import functools
+from collections import namedtuple
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import map_coordinates
+from .surface_sampling import read_lta
+from .resample import fsl_scaled
+from .atomic import atomic_write
+
+# source world coordinates (3 x X x Y x Z) of each voxel of a grid
+Warp = namedtuple('Warp', ['coords', 'affine'])
+
+INVERT_ITERS = 20  # fixed point iterations when inverting a warp
+INVERT_TOL = .01  # mm, stop once every point is this close
+CHUNK_POINTS = 2 ** 20  # points transformed at a time
+CACHED_TRANSFORMS = 8  # transforms kept in memory, across subjects
+
+
+def space_image(subject, session, space):
+
+    """ Path of the volume defining the grid of a space """
+
+    if space == 'func':
+        reg_dir = f'derivatives/registration/sub-{subject}/{session}'
+        return glob.glob(f'{reg_dir}/example_func.nii*')[0]
+    if space == 'highres':
+        return f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}/mri/orig/001.nii'
+    return f'{os.environ["FSLDIR"]}/data/standard/MNI152_T1_2mm.nii.gz'
+
+
+def read_affine(path, src, dst):
+
+    """
+    Reads a FreeSurfer .lta or FSL .mat as a world src -> dst matrix.
+    src and dst (nibabel images) are only needed for .mat files.
+    """
+
+    if path.endswith('.lta'):
+        return read_lta(path)
+    return (dst.affine @ np.linalg.inv(fsl_scaled(dst)) @ np.loadtxt(path) @
+            fsl_scaled(src) @ np.linalg.inv(src.affine))
+
+
+def write_lta(matrix, path):
+
+    """ Writes a world src -> dst matrix as a LINEAR_RAS_TO_RAS .lta """
+
+    rows = '\n'.join(' '.join(f'{v:.10f}' for v in row) for row in matrix)
+    with atomic_write(path, 'w') as f:
+        f.write(f'type      = 1 # LINEAR_RAS_TO_RAS\nnxforms   = 1\n'
+                f'mean      = 0.0000 0.0000 0.0000\nsigma     = 1.0000\n'
+                f'1 4 4\n{rows}\n'
+                f'src volume info\nvalid = 0\ndst volume info\nvalid = 0\n')
+
+
+def read_fnirt_field(path, src):
+
+    """
+    Reads a FNIRT displacement field (--fout, relative, affine included) as
+    a Warp on the field's (destination) grid.
+    """
+
+    field = nib.load(path)
+    dst_scaled = fsl_scaled(field)
+    ijk = np.indices(field.shape[:3], dtype=np.float32).transpose(1, 2, 3, 0)
+    scaled = ijk @ dst_scaled[:3, :3].T + dst_scaled[:3, 3]
+    scaled += field.get_fdata(dtype=np.float32)
+    to_world = src.affine @ np.linalg.inv(fsl_scaled(src))
+    coords = scaled @ to_world[:3, :3].T.astype(np.float32) + to_world[:3, 3]
+    return Warp(np.ascontiguousarray(coords.transpose(3, 0, 1, 2),
+                                     dtype=np.float32), field.affine)
+
+
+def grid_points(shape, affine, start=0, stop=None):
+
+    """
+    World coordinates of the voxels of a grid, X x Y x Z x 3, optionally
+    only the slab of z planes start:stop
+    """
+
+    stop = shape[2] if stop is None else stop
+    ijk = np.indices((*shape[:2], stop - start),
+                     dtype=np.float32).transpose(1, 2, 3, 0)
+    ijk[..., 2] += start
+    return ijk @ affine[:3, :3].T.astype(np.float32) + affine[:3, 3]
+
+
+def pull(transform, points):
+
+    """
+    Source world coordinates of destination world points (N x 3), i.e.
+    the inverse mapping that resampling needs.
+    """
+
+    if not isinstance(transform, Warp):
+        inverse = np.linalg.inv(transform)
+        return points @ inverse[:3, :3].T + inverse[:3, 3]
+    to_grid = np.linalg.inv(transform.affine)
+    ijk = (points @ to_grid[:3, :3].T + to_grid[:3, 3]).T
+    return np.stack([map_coordinates(component, ijk, order=1, mode='nearest')
+                     for component in transform.coords],
+                    axis=-1).astype(np.float32)
+
+
+def _affine_fit(warp):
+
+    """ Least squares destination -> source affine approximating a Warp """
+
+    step = max(1, int(np.prod(warp.coords.shape[1:]) ** (1 / 3) // 32))
+    coords = np.asarray(warp.coords[:, ::step, ::step, ::step])
+    points = grid_points(coords.shape[1:], warp.affine @ np.diag(
+        [step, step, step, 1])).reshape(-1, 3)
+    coords = coords.reshape(3, -1).T
+    design = np.column_stack([points, np.ones(len(points))])
+    fit = np.linalg.lstsq(design, coords, rcond=None)[0]
+    dst2src = np.eye(4)
+    dst2src[:3] = fit.T
+    return dst2src
+
+
+def push(transform, points, iters=INVERT_ITERS, tol=INVERT_TOL):
+
+    """
+    Destination world coordinates of source world points (N x 3), i.e. the
+    pull of the inverse transform. A Warp is inverted at just these points
+    by fixed point iteration: starting from the inverse of its best affine
+    approximation, each point q is moved by the affine-scaled error between
+    where it samples and its target, until within tol (mm).
+    """
+
+    if not isinstance(transform, Warp):
+        return points @ transform[:3, :3].T + transform[:3, 3]
+    src2dst = np.linalg.inv(_affine_fit(transform)).astype(np.float32)
+    q = points @ src2dst[:3, :3].T + src2dst[:3, 3]
+    active = np.arange(len(q))  # points not yet converged
+    for _ in range(iters):
+        error = pull(transform, q[active]) - points[active]
+        q[active] -= error @ src2dst[:3, :3].T
+        active = active[np.abs(error).max(axis=1) >= tol]
+        if not len(active):
+            break
+    return q
+
+
+def _registrations(subject, session):
+
+    """
+    Paths of the registrations stored by registration(). The FNIRT field is
+    used between highres and standard if present, else the linear FLIRT
+    matrix.
+    """
+
+    fnirt_dir = (f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}/mri/'
+                 f'transforms/fnirt')
+    field = f'{fnirt_dir}/highres2standard_field.nii.gz'
+    return {('func', 'highres'): (f'derivatives/registration/sub-{subject}/'
+                                  f'{session}/example_func2highres.lta'),
+            ('highres', 'standard'): field if op.isfile(field) else
+            f'{fnirt_dir}/highres2standard.mat'}
+
+
+def _session_key(session, src, dst):
+
+    """ Session, or None for subject-level transforms (not involving func) """
+
+    return session if 'func' in (src, dst) else None
+
+
+def _read_registration(subject, session, src, dst):
+
+    """ Loads a stored registration, once per subject if subject-level """
+
+    return _load_registration(subject, _session_key(session, src, dst), src,
+                              dst)
+
+
+@functools.lru_cache(maxsize=CACHED_TRANSFORMS)
+def _load_registration(subject, session, src, dst):
+    path = _registrations(subject, session)[(src, dst)]
+    if path.endswith('.lta'):
+        return read_lta(path)
+    highres = nib.load(space_image(subject, session, 'highres'))
+    if path.endswith('.mat'):
+        return read_affine(path, highres,
+                           nib.load(space_image(subject, session, dst)))
+    return read_fnirt_field(path, highres)
+
+
+def _route(subject, session, src, dst):
+
+    """
+    Stored registrations leading from src to dst (via highres), as
+    (transform, inverted) pairs.
+    """
+
+    route = [src, dst] if 'highres' in (src, dst) else [src, 'highres', dst]
+    registrations = _registrations(subject, session)
+    steps = []
+    for a, b in zip(route[:-1], route[1:]):
+        if (a, b) in registrations:
+            steps.append((_read_registration(subject, session, a, b), False))
+        else:
+            steps.append((_read_registration(subject, session, b, a), True))
+    return steps
+
+
+def source_points(steps, points):
+
+    """ Source world coordinates of destination points (N x 3) of a route """
+
+    for step, inverted in reversed(steps):
+        points = push(step, points) if inverted else pull(step, points)
+    return points
+
+
+def slabs(shape, max_voxels=CHUNK_POINTS):
+
+    """ (start, stop) z planes of slabs of a grid holding <= max_voxels """
+
+    planes = max(1, max_voxels // (shape[0] * shape[1]))
+    return [(start, min(start + planes, shape[2]))
+            for start in range(0, shape[2], planes)]
+
+
+def transform_path(subject, session, src, dst):
+
+    """
+    Where a derived transform is stored: an .lta for affines, .npy Warp
+    coordinates otherwise. Subject-level transforms go in the FNIRT
+    directory, those involving func in the session's registration directory.
+    """
+
+    if 'func' in (src, dst):
+        out_dir = f'derivatives/registration/sub-{subject}/{session}/transforms'
+    else:
+        out_dir = (f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}/mri/'
+                   f'transforms/fnirt/transforms')
+    return f'{out_dir}/{src}2{dst}'
+
+
+def get_transform(subject, session, src, dst):
+
+    """
+    Transform from space src to space dst ('func', 'highres' or
+    'standard'), derived from the stored registrations if needed.
+
+    Args:
+        subject (str): subject ID, without the 'sub-' prefix
+        session (str): session directory name (unused between highres and
+            standard)
+
+    Returns:
+        transform (np.ndarray or Warp): see module docstring
+    """
+
+    return _get_transform(subject, _session_key(session, src, dst), src, dst)
+
+
+@functools.lru_cache(maxsize=CACHED_TRANSFORMS)
+def _get_transform(subject, session, src, dst):
+    registrations = _registrations(subject, session)
+    if (src, dst) in registrations:
+        return _read_registration(subject, session, src, dst)
+
+    # derived transforms are stored, and reused unless a registration changed
+    path = transform_path(subject, session, src, dst)
+    sources = [source for pair, source in registrations.items()
+               if set(pair) & {src, dst} - {'highres'}]
+    for ext in ['.lta', '.npy']:
+        if (op.isfile(path + ext) and
+                op.getmtime(path + ext) >= max(map(op.getmtime, sources))):
+            if ext == '.lta':
+                return read_lta(path + ext)
+            affine = nib.load(space_image(subject, session, dst)).affine
+            return Warp(np.load(path + ext, mmap_mode='r'), affine)
+
+    steps = _route(subject, session, src, dst)
+    if not any(isinstance(step, Warp) for step, _ in steps):
+        transform = np.eye(4)
+        for step, inverted in steps:
+            transform = (np.linalg.inv(step) if inverted else step) @ transform
+    else:
+        dst_img = nib.load(space_image(subject, session, dst))
+        coords = np.empty((3, *dst_img.shape[:3]), dtype=np.float32)
+        for start, stop in slabs(dst_img.shape):
+            points = grid_points(dst_img.shape, dst_img.affine, start, stop)
+            coords[..., start:stop] = source_points(
+                steps, points.reshape(-1, 3)).T.reshape(
+                3, *points.shape[:3])
+        transform = Warp(coords, dst_img.affine)
+
+    os.makedirs(op.dirname(path), exist_ok=True)
+    if isinstance(transform, Warp):
+        with atomic_write(f'{path}.npy') as f:
+            np.save(f, transform.coords)
+    else:
+        write_lta(transform, f'{path}.lta')
+    return transform
+
+
+def transform_file(subject, session, src, dst):
+
+    """ As get_transform, but returns the path of the file holding it """
+
+    get_transform(subject, session, src, dst)
+    registrations = _registrations(subject, session)
+    if (src, dst) in registrations:
+        return registrations[(src, dst)]
+    path = transform_path(subject, session, src, dst)
+    return f'{path}.lta' if op.isfile(f'{path}.lta') else f'{path}.npy'
+
+
+def transform_volumes(subject, session, src, dst, in_paths, out_paths=None,
+                      order=1, thresh=None, max_voxels=CHUNK_POINTS):
+
+    """
+    Resamples volumes from space src into space dst, as applywarp with
+    --premat/--postmat but without writing the composite warp. The
+    destination grid is processed in slabs of z planes: the source position
+    of each voxel in a slab is found once, through the stored registrations
+    (a warp is inverted only at those points), and every volume is sampled
+    there. Memory is bounded by the volumes themselves plus one slab, also
+    for 0.6 mm anatomical grids.
+
+    Args:
+        subject (str): subject ID, without the 'sub-' prefix
+        session (str): session directory name
+        src, dst (str): 'func', 'highres' or 'standard'
+        in_paths (list): 3D volumes in src space, as paths or images
+        out_paths (list): optionally save results with dst's geometry
+        order (int): 0 nearest neighbour, 1 trilinear
+        thresh (float): binarise outputs (value > thresh), see
+            resample.resample
+        max_voxels (int): destination voxels per slab
+
+    Returns:
+        outputs (list): resampled volumes, uint8 if thresholded
+    """
+
+    steps = _route(subject, session, src, dst)
+    ref = nib.load(space_image(subject, session, dst))
+    sources = [nib.load(path) if isinstance(path, str) else path
+               for path in in_paths]
+    volumes = [np.asarray(img.dataobj) if not order else
+               img.get_fdata(dtype=np.float32) for img in sources]
+    outputs = [np.zeros(ref.shape[:3], dtype=np.uint8 if thresh is not None
+                        else volume.dtype) for volume in volumes]
+
+    for start, stop in slabs(ref.shape, max_voxels):
+        points = grid_points(ref.shape, ref.affine, start, stop)
+        world = source_points(steps, points.reshape(-1, 3))
+        for img, volume, out in zip(sources, volumes, outputs):
+            to_vox = np.linalg.inv(img.affine)
+            ijk = (world @ to_vox[:3, :3].T + to_vox[:3, 3]).T
+            values = map_coordinates(volume, ijk, order=order,
+                                     mode='constant', cval=0)
+            if thresh is not None:
+                values = values > thresh
+            out[..., start:stop] = values.reshape(points.shape[:3])
+
+    for out, path in zip(outputs, out_paths or []):
+        header = ref.header.copy()
+        header.set_data_dtype(out.dtype)
+        nib.save(nib.Nifti1Image(out, ref.affine, header), path)
+    return outputs